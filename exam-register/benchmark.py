@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Giacomo Ferretti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from register import ExamRegistration, SOUP_PARSERS, EXAMS_FRAGMENTS, SURVEY_FRAGMENTS, SURVEY_STEPS, parse, run_form_steps, extract_execution_flow, extract_exams, extract_exam_sessions, extract_registration_form, extract_receipt, extract_survey_form
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Entry point of the startup benchmark
+MODULE = 'register'
+
+# Modules only some code paths need, they must not load at startup
+HEAVY_MODULES = ['bs4', 'html5lib', 'lxml', 'youtube_dl']
+
+# Saved copies of every page type, the url they were served from and the fragments parsed
+PAGES = [
+    ('login.html', extract_execution_flow, (), None),
+    ('exams.html', extract_exams, (ExamRegistration.endpoints['exams_list'],), EXAMS_FRAGMENTS),
+    ('exams_malformed.html', extract_exams, (ExamRegistration.endpoints['exams_list'],), EXAMS_FRAGMENTS),
+    ('exam_sessions.html', extract_exam_sessions, ('http://studente.unimi.it/foIscrizioneEsami/esame/selezioneAppello?3',), None),
+    ('registration.html', extract_registration_form, ('http://studente.unimi.it/foIscrizioneEsami/esame/iscrizione?4',), None),
+    ('receipt.html', extract_receipt, ('http://studente.unimi.it/foIscrizioneEsami/esame/iscrizione?5',), None),
+    ('survey.html', extract_survey_form, ('http://studente.unimi.it/foIscrizioneEsami/questionario/questionario?6',), SURVEY_FRAGMENTS),
+]
+
+
+class PageServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content, latency=0.0):
+        super().__init__(('127.0.0.1', 0), PageHandler)
+        self.content = content
+        self.latency = latency
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on idle keep-alive connections
+        pass
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body go out in separate writes, Nagle would hold the body for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        # Round trip to the server
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.end_headers()
+        self.wfile.write(self.server.content)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(content, extract, extra, parsers, repeat, only=None):
+    try:
+        result = parse(content, extract, *extra, parsers=parsers, only=only)
+    except Exception as e:
+        return None, 'failed ({})'.format(type(e).__name__)
+
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        parse(content, extract, *extra, parsers=parsers, only=only)
+
+    return (time.perf_counter() - start_time) / repeat, result
+
+
+def bench_parse(args):
+    # html5lib is the reference, it is what the pages were always parsed with
+    backends = [('html5lib', ['html5lib'])] + [(x, [x]) for x in args.parsers if x != 'html5lib'] + [('default', SOUP_PARSERS)]
+    mismatch = False
+
+    print('{:>22} {:>12} {:>10} {:>8}  {}'.format('page', 'parser', 'ms/page', 'speedup', 'data'))
+    for name, extract, extra, only in PAGES:
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            content = f.read()
+
+        reference = None
+        for label, parsers in backends:
+            elapsed, result = measure(content, extract, extra, parsers, args.repeat, only)
+            if label == 'html5lib':
+                reference, baseline = result, elapsed
+
+            if elapsed is None:
+                check = result
+            elif result == reference:
+                check = 'same'
+            else:
+                check = 'DIFFERENT'
+
+            # The default chain must never change what gets extracted
+            if label == 'default' and check != 'same':
+                mismatch = True
+
+            print('{:>22} {:>12} {:>10} {:>8}  {}'.format(
+                name, label, '-' if elapsed is None else '{:.2f}'.format(elapsed * 1000), '-' if elapsed is None else '{:.1f}x'.format(baseline / elapsed), check
+            ))
+
+    if mismatch:
+        print('ERROR: the default parsers extract different data than html5lib.')
+        exit(1)
+
+
+def bench_survey(args):
+    # Every survey page is answered with the saved one, only the timings matter
+    with open(os.path.join(FIXTURES, 'survey.html'), 'rb') as f:
+        server = PageServer(f.read(), args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/questionario?6'.format(server.server_address[1])
+
+    # html5lib over the whole page is how every step was parsed before
+    engines = [('html5lib', ['html5lib'], None), ('default', SOUP_PARSERS, SURVEY_FRAGMENTS)]
+
+    results = []
+    for label, parsers, only in engines:
+        session = requests.session()
+        best = None
+        for _ in range(args.repeat):
+            timings = []
+            r = session.get(url)
+            run_form_steps(session, r, SURVEY_STEPS, parsers=parsers, only=only, timings=timings)
+            if best is None or sum(x['parse'] + x['request'] for x in timings) < sum(x['parse'] + x['request'] for x in best):
+                best = timings
+        results.append((label, best))
+
+    print('Survey of {} steps, {:.0f}ms round trip, best of {} runs'.format(len(SURVEY_STEPS), args.latency * 1000, args.repeat))
+    print('{:>4} {:>12} {:>28} {:>28}'.format('', 'step', *('{} parse/request ms'.format(x[0]) for x in results)))
+    for i, step in enumerate(SURVEY_STEPS):
+        print('{:>4} {:>12} {:>28} {:>28}'.format(i + 1, step[0], *('{:.2f} / {:.2f}'.format(x[1][i]['parse'] * 1000, x[1][i]['request'] * 1000) for x in results)))
+
+    print('{:>4} {:>12} {:>28} {:>28}'.format('', 'total', *('{:.1f} / {:.1f}'.format(sum(y['parse'] for y in x[1]) * 1000, sum(y['request'] for y in x[1]) * 1000) for x in results)))
+
+    server.shutdown()
+
+
+def python(args, env):
+    return subprocess.run([sys.executable] + args, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True)
+
+
+def startup_env(cache):
+    # Bytecode cached outside the tree, like an installed copy, not compiled on every run
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=cache)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def startup_times(codes, repeat, env):
+    # Interleaved, so a busy machine slows every variant alike, best run wins
+    times = [[] for _ in codes]
+    for _ in range(repeat):
+        for i, code in enumerate(codes):
+            start_time = time.perf_counter()
+            python(['-c', code], env)
+            times[i].append(time.perf_counter() - start_time)
+
+    return [min(x) for x in times]
+
+
+def module_time(module, repeat, env):
+    # Cumulative import time of the module alone in us, requests is loaded first so it is not counted
+    times = []
+    for _ in range(repeat):
+        output = python(['-X', 'importtime', '-c', 'import requests; import ' + module], env).stderr
+        times.append(int(re.search(r'import time:\s+[0-9]+ \|\s+([0-9]+) \| {}$'.format(module), output, re.MULTILINE).group(1)))
+
+    return min(times)
+
+
+def import_tree(module, env):
+    # Direct imports of the module and their cumulative time in us, from -X importtime
+    output = python(['-X', 'importtime', '-c', 'import ' + module], env).stderr
+
+    children = []
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+[0-9]+ \|\s+([0-9]+) \|( *)(\S+)$', line)
+        if not match:
+            continue
+
+        depth = len(match.group(2)) // 2
+        if depth == 0 and match.group(3) != module:
+            children = []
+        elif depth == 1:
+            children.append((int(match.group(1)), match.group(3)))
+
+    return sorted(children, reverse=True)
+
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as cache:
+        env = startup_env(cache)
+
+        # The first run writes the bytecode cache
+        python(['-c', 'import ' + MODULE], env)
+
+        python_, requests_, total = startup_times(['pass', 'import requests', 'import ' + MODULE], args.repeat, env)
+        own = module_time(MODULE, args.repeat, env) / 1000
+
+        loaded = python(['-c', 'import sys, {}; print(*sys.modules)'.format(MODULE)], env).stdout.split()
+        heavy = sorted(set(x.split('.')[0] for x in loaded) & set(HEAVY_MODULES))
+
+        tree = import_tree(MODULE, env)
+
+    print('Cold start of {}, best of {} runs'.format(MODULE, args.repeat))
+    print('{:>24} {:>8.1f}ms'.format('python -c pass', python_ * 1000))
+    print('{:>24} {:>8.1f}ms'.format('+ requests', (requests_ - python_) * 1000))
+    print('{:>24} {:>8.1f}ms'.format('+ ' + MODULE, (total - requests_) * 1000))
+    print('{:>24} {:>8.1f}ms (target {}ms)'.format('total', total * 1000, args.target))
+    print('{:>24} {:>8.1f}ms (-X importtime, after requests)'.format('import ' + MODULE, own))
+
+    print()
+    print('Slowest imports of {}:'.format(MODULE))
+    for cumulative, name in tree[:args.top]:
+        print('{:>24} {:>8.1f}ms'.format(name, cumulative / 1000))
+
+    # requests is needed by every entry point, the rest of the startup is ours
+    failed = False
+    if heavy:
+        print('ERROR: {} imported at startup.'.format(', '.join(heavy)))
+        failed = True
+    # Wall time differences are noise, the gate is the import time of the module itself
+    if own > args.budget:
+        print('ERROR: importing {} takes {:.1f}ms on top of requests, budget is {}ms.'.format(MODULE, own, args.budget))
+        failed = True
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parse_parser = subparsers.add_parser('parse', help='parse the saved pages with every backend and compare the extracted data')
+    parse_parser.add_argument('-p', '--parsers', help='BeautifulSoup backends to compare with html5lib', nargs='+', default=['lxml', 'html.parser'])
+    parse_parser.add_argument('--repeat', help='parses per page and backend', type=int, default=50)
+    parse_parser.set_defaults(func=bench_parse)
+
+    survey_parser = subparsers.add_parser('survey', help='parse and request time of every survey step against a local server')
+    survey_parser.add_argument('-l', '--latency', help='seconds the server takes to answer', type=float, default=0.03)
+    survey_parser.add_argument('--repeat', help='runs per engine', type=int, default=5)
+    survey_parser.set_defaults(func=bench_survey)
+
+    startup_parser = subparsers.add_parser('startup', help='cold start time and heavy imports of {}.py'.format(MODULE))
+    startup_parser.add_argument('--repeat', help='runs per measurement', type=int, default=15)
+    startup_parser.add_argument('--top', help='direct imports to show', type=int, default=8)
+    startup_parser.add_argument('--budget', help='ms allowed on top of importing requests', type=float, default=30)
+    startup_parser.add_argument('--target', help='total cold start to aim for, in ms', type=float, default=100)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
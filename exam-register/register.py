@@ -16,14 +16,21 @@
 
 import os
 import re
+import sys
+import csv
 import json
 import time
+import hashlib
 import pathlib
-from urllib.parse import urljoin
+import email.utils
+import threading
+import http.client
+import concurrent.futures
+from urllib.parse import urljoin, urlsplit
+from datetime import datetime
 import argparse
 
 import requests
-from bs4 import BeautifulSoup
 
 # Config
 VERBOSE           = True
@@ -32,7 +39,8 @@ PROXY_ENABLED     = False
 PROXY_URL         = 'http://localhost:8080'
 VERIFY_ENABLED    = True
 SUPPRESS_WARNINGS = False
-SOUP_PARSER       = 'html5lib'
+SOUP_PARSERS      = ['lxml', 'html5lib']
+SESSION_FILE      = 'session.json'
 
 # Initaliaze necessary components
 headers = {
@@ -50,14 +58,40 @@ if SUPPRESS_WARNINGS:
     __import__('urllib3').disable_warnings(__import__('urllib3').exceptions.InsecureRequestWarning)
 
 
+class NotModified(Exception):
+    pass
+
+
 class Downloader():
-    def __init__(self, download_folder=None):
+    # Smallest byte range worth its own connection
+    min_segment_size = 1024 * 1024
+
+    # Bounds of the adaptive chunk size
+    min_chunk_size = 64 * 1024
+    max_chunk_size = 4 * 1024 * 1024
+
+    # Errors worth another attempt
+    retryable_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, http.client.HTTPException, ConnectionError, TimeoutError, EOFError)
+
+    # Seconds between two progress lines
+    progress_interval = 0.5
+
+    def __init__(self, download_folder=None, chunk_size=None, progress=False):
         if download_folder:
             self.download_folder = download_folder
             pathlib.Path(self.download_folder).mkdir(parents=True, exist_ok=True)
         else:
             self.download_folder = ''
 
+        # None picks a chunk size from Content-Length
+        self.chunk_size = chunk_size
+
+        # Metrics of every transfer, shared by all threads
+        self.progress = progress
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.last_report = 0
+
     # https://stackoverflow.com/questions/1094841/
     @staticmethod
     def sizeof_fmt(num, suffix='B'):
@@ -67,56 +101,417 @@ class Downloader():
             num /= 1024.0
         return '%.1f%s%s' % (num, 'Yi', suffix)
 
-    def download(self, url, session=None, name=None):
+    def download(self, url, session=None, name=None, retries=3, segments=1, validators=None):
         # Extract name from url
         if name is None:
             name = url.split('/')[-1]
 
         output_file = os.path.join(self.download_folder, name)
+        part_file = output_file + '.part'
+
+        # A killed segmented download leaves holes, it cannot be resumed
+        if os.path.exists(output_file + '.alloc'):
+            os.remove(output_file + '.alloc')
+
+        # Only a file on disk can be revalidated
+        if not os.path.exists(output_file):
+            validators = None
 
         # Prepare session
         if session:
             session_ = session
         else:
             session_ = requests.session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=segments)
+            session_.mount('http://', adapter)
+            session_.mount('https://', adapter)
+
+        transfer = {
+            'url': url,
+            'file': output_file,
+            'status': 'active',
+            'size': None,
+            'bytes': 0,
+            'ttfb': None,
+            'start': time.time(),
+            'duration': None,
+            'speed': None,
+            'retries': 0,
+            'etag': None,
+            'last_modified': None,
+            'error': None
+        }
+        with self.lock:
+            self.transfers.append(transfer)
+
+        start_time = time.perf_counter()
+        try:
+            # Split in byte ranges when the server allows it, unless there is a download to resume
+            if segments <= 1 or os.path.exists(part_file) or not self.download_segments(url, session_, output_file, segments, retries, transfer, validators):
+                for attempt in range(retries + 1):
+                    try:
+                        self.download_part(url, session_, output_file, transfer, validators)
+                        break
+                    except self.retryable_errors:
+                        if attempt == retries:
+                            raise
+                        self.count(transfer, retries=1)
+
+            # Only complete files get their final name
+            os.replace(part_file, output_file)
+            transfer['status'] = 'done'
+        except NotModified:
+            # The file on disk is still current
+            transfer['status'] = 'unchanged'
+        except BaseException as e:
+            transfer['status'] = 'failed'
+            transfer['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            transfer['duration'] = time.perf_counter() - start_time
+            if transfer['duration']:
+                transfer['speed'] = transfer['bytes'] / transfer['duration']
+            self.report()
+
+        return transfer
+
+    def count(self, transfer, size=0, retries=0):
+        with self.lock:
+            transfer['bytes'] += size
+            transfer['retries'] += retries
+        self.report()
 
-        with session_.get(url, stream=True) as r:
-            r.raise_for_status()
+    @staticmethod
+    def record_response(transfer, r):
+        # Time from sending the request to parsing the response headers
+        if transfer['ttfb'] is None:
+            transfer['ttfb'] = r.elapsed.total_seconds()
+            transfer['etag'] = r.headers.get('ETag')
+            transfer['last_modified'] = r.headers.get('Last-Modified')
 
-            # Check if Transfer-Encoding is chunked
-            if r.headers.get('Transfer-Encoding') and r.headers.get('Transfer-Encoding').lower() == 'chunked':
-                chunk_size = None
-            else:
-                chunk_size = 4096
+    @staticmethod
+    def conditional_headers(validators):
+        headers_ = {}
+        if validators and validators.get('etag'):
+            headers_['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers_['If-Modified-Since'] = validators['last_modified']
+        return headers_
+
+    def report(self, force=False):
+        if not self.progress:
+            return
+
+        with self.lock:
+            now = time.perf_counter()
+            if not force and now - self.last_report < self.progress_interval:
+                return
+            self.last_report = now
+
+            active = [x for x in self.transfers if x['status'] == 'active']
+            done = sum(1 for x in self.transfers if x['status'] in ('done', 'unchanged'))
+            failed = sum(1 for x in self.transfers if x['status'] == 'failed')
+            received = sum(x['bytes'] for x in self.transfers)
+            elapsed = time.time() - min((x['start'] for x in self.transfers), default=time.time())
+
+            # Remaining bytes are only known for transfers with a Content-Length
+            remaining = ''
+            if active and all(x['size'] for x in active):
+                remaining = ', {} left'.format(self.sizeof_fmt(sum(x['size'] - x['bytes'] for x in active)))
+
+            print('\r\x1b[K{} done, {} failed, {} active: {} at {}/s{}'.format(
+                done, failed, len(active), self.sizeof_fmt(received), self.sizeof_fmt(received / elapsed if elapsed else 0), remaining
+            ), end='', file=sys.stderr, flush=True)
+
+    def summary(self):
+        with self.lock:
+            transfers = [dict(x) for x in self.transfers]
+
+        received = sum(x['bytes'] for x in transfers)
+        duration = 0
+        if transfers:
+            duration = max(x['start'] + (x['duration'] or 0) for x in transfers) - min(x['start'] for x in transfers)
 
-            # Estimate time
-            file_size = r.headers.get('Content-Length')
-            if file_size:
-                file_size = int(file_size)
+        return {
+            'files': len(transfers),
+            'failed': sum(1 for x in transfers if x['status'] == 'failed'),
+            'bytes': received,
+            'duration': duration,
+            'speed': received / duration if duration else None,
+            'retries': sum(x['retries'] for x in transfers),
+            'transfers': transfers
+        }
 
-            downloaded = 0
-            start_time = time.perf_counter()
+    def write_summary(self, path):
+        summary = self.summary()
+
+        # Prometheus textfile for node_exporter, JSON otherwise
+        if path.endswith('.prom'):
+            def escape(value):
+                return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+            metrics = [
+                ('bytes_total', 'counter', 'Bytes received.', 'bytes'),
+                ('size_bytes', 'gauge', 'Expected size of the file.', 'size'),
+                ('ttfb_seconds', 'gauge', 'Time to the first response headers.', 'ttfb'),
+                ('duration_seconds', 'gauge', 'Time spent on the transfer.', 'duration'),
+                ('speed_bytes_per_second', 'gauge', 'Average throughput of the transfer.', 'speed'),
+                ('retries_total', 'counter', 'Attempts after the first one.', 'retries'),
+            ]
+
+            # Duplicate series make node_exporter reject the file, the last transfer of a file wins
+            latest = {}
+            for transfer in summary['transfers']:
+                latest[(transfer['url'], transfer['file'])] = transfer
+
+            lines = []
+            for name, kind, description, key in metrics:
+                lines.append('# HELP download_{} {}'.format(name, description))
+                lines.append('# TYPE download_{} {}'.format(name, kind))
+                for transfer in latest.values():
+                    if transfer[key] is not None:
+                        lines.append('download_{}{{url="{}",file="{}",status="{}"}} {}'.format(name, escape(transfer['url']), escape(transfer['file']), transfer['status'], transfer[key]))
+
+            lines.append('# HELP download_failed_files Files that could not be downloaded.')
+            lines.append('# TYPE download_failed_files gauge')
+            lines.append('download_failed_files {}'.format(summary['failed']))
+            lines.append('# HELP download_last_run_timestamp_seconds End of the last run.')
+            lines.append('# TYPE download_last_run_timestamp_seconds gauge')
+            lines.append('download_last_run_timestamp_seconds {}'.format(time.time()))
+            content = '\n'.join(lines) + '\n'
+        else:
+            content = json.dumps(summary, indent=2)
 
-            # Save file
-            with open(output_file, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    f.write(chunk)
+        # Replace atomically, collectors may read it at any time
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
 
-            #         if file_size:
-            #             downloaded += len(chunk)
+        return summary
 
-            #             downloaded_formatted = self.sizeof_fmt(downloaded)
-            #             file_size_formatted = self.sizeof_fmt(file_size)
-            #             mbps = downloaded // (time.perf_counter() - start_time) / 100000
-            #             percentage = downloaded / file_size * 100
+    def get_chunk_size(self, file_size=None):
+        if self.chunk_size:
+            return self.chunk_size
 
-            #             print('\r\x1b[K{} of {} [{:3.1f}%] at {:3.1f} Mbps'.format(downloaded_formatted, file_size_formatted, percentage, mbps), end='', flush=True)
+        # About 64 reads per file
+        return min(max((file_size or 0) // 64, self.min_chunk_size), self.max_chunk_size)
 
-            # print('\r\x1b[KDone!')
+    @staticmethod
+    def copy_stream(r, f, chunk_size, limit=None):
+        # Compressed bodies need urllib3 to decode them
+        if r.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if limit is not None:
+                    chunk = chunk[:limit]
+                    limit -= len(chunk)
+
+                f.write(chunk)
+                yield len(chunk)
+
+                if limit == 0:
+                    return
+            return
+
+        # Read straight into one reused buffer, urllib3 would allocate a new bytes object per read
+        fp = getattr(r.raw, '_fp', None) or r.raw
+        buffer = memoryview(bytearray(chunk_size))
+
+        while limit is None or limit > 0:
+            size = fp.readinto(buffer if limit is None or limit >= chunk_size else buffer[:limit])
+            if not size:
+                break
+
+            f.write(buffer[:size])
+            if limit is not None:
+                limit -= size
+
+            yield size
+
+        # requests never saw the body, hand the connection back to the pool or closing the response drops it
+        if fp is not r.raw and fp.isclosed():
+            r._content_consumed = True
+            r.raw.release_conn()
+
+    def download_segments(self, url, session, output_file, segments, retries=3, transfer=None, validators=None):
+        # Probe size and range support
+        with session.get(url, stream=True, headers=dict(self.conditional_headers(validators), Range='bytes=0-0')) as r:
+            if transfer:
+                self.record_response(transfer, r)
+
+            if r.status_code == 304:
+                raise NotModified(url)
+
+            r.raise_for_status()
+
+            content_range = re.match(r'bytes 0-0/([0-9]+)$', r.headers.get('Content-Range', ''))
+            if r.status_code != 206 or not content_range:
+                return False
+
+        file_size = int(content_range.group(1))
+        segments = min(segments, file_size // self.min_segment_size)
+        if segments < 2:
+            return False
+
+        if transfer:
+            transfer['size'] = file_size
+
+        # Segments are written at their offsets, the file becomes the .part file only once complete
+        alloc_file = output_file + '.alloc'
+        with open(alloc_file, 'wb') as f:
+            f.truncate(file_size)
+
+        segment_size = file_size // segments
+        bounds = [(i * segment_size, (i + 1) * segment_size - 1) for i in range(segments)]
+        bounds[-1] = (bounds[-1][0], file_size - 1)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(self.download_segment, url, session, alloc_file, start, end, retries, transfer) for start, end in bounds]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            # Holes in it cannot be told apart from data, so it cannot be resumed
+            os.remove(alloc_file)
+            raise
 
+        os.replace(alloc_file, output_file + '.part')
 
         return True
 
+    def download_segment(self, url, session, alloc_file, start, end, retries=3, transfer=None):
+        position = start
+
+        for attempt in range(retries + 1):
+            try:
+                with session.get(url, stream=True, headers={'Range': 'bytes={}-{}'.format(position, end)}) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise EOFError('Server ignored the range of "{}".'.format(url))
+
+                    # Write at its offset, never past the segment
+                    with open(alloc_file, 'r+b') as f:
+                        f.seek(position)
+                        for size in self.copy_stream(r, f, self.get_chunk_size(end + 1 - start), limit=end + 1 - position):
+                            position += size
+                            if transfer:
+                                self.count(transfer, size)
+
+                if position != end + 1:
+                    raise EOFError('Incomplete segment of "{}": {} of {} bytes.'.format(url, position - start, end + 1 - start))
+
+                return
+            except self.retryable_errors:
+                if attempt == retries:
+                    raise
+                if transfer:
+                    self.count(transfer, retries=1)
+
+    def download_part(self, url, session, output_file, transfer=None, validators=None):
+        part_file = output_file + '.part'
+
+        # Resume a previous attempt, or ask only for a changed file
+        downloaded = 0
+        headers_ = {}
+        if os.path.exists(part_file):
+            downloaded = os.path.getsize(part_file)
+        if downloaded:
+            headers_['Range'] = 'bytes={}-'.format(downloaded)
+        else:
+            headers_.update(self.conditional_headers(validators))
+
+        with session.get(url, stream=True, headers=headers_) as r:
+            if transfer:
+                self.record_response(transfer, r)
+
+            if r.status_code == 304 and not downloaded:
+                raise NotModified(url)
+
+            if r.status_code == 416:
+                # Already complete
+                if r.headers.get('Content-Range') == 'bytes */{}'.format(downloaded):
+                    return
+
+                os.remove(part_file)
+                raise EOFError('Cannot resume "{}", restarting.'.format(part_file))
+
+            r.raise_for_status()
+
+            # Range not supported, start from scratch
+            if r.status_code != 206:
+                downloaded = 0
+
+            accept_ranges = r.status_code == 206 or r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+            # The size of compressed bodies is unknown
+            file_size = r.headers.get('Content-Length')
+            if file_size and r.headers.get('Content-Encoding', 'identity').lower() == 'identity':
+                file_size = downloaded + int(file_size)
+            else:
+                file_size = None
+
+            if transfer:
+                transfer['size'] = file_size
+
+            # Save file, its size is always the bytes received so far
+            with open(part_file, 'ab' if downloaded else 'wb') as f:
+                try:
+                    for size in self.copy_stream(r, f, self.get_chunk_size(file_size)):
+                        downloaded += size
+                        if transfer:
+                            self.count(transfer, size)
+                except BaseException:
+                    # Nothing to resume from
+                    if not accept_ranges:
+                        f.truncate(0)
+                    raise
+
+        # Check size before renaming
+        if file_size and os.path.getsize(part_file) != file_size:
+            raise EOFError('Incomplete download of "{}": {} of {} bytes.'.format(url, os.path.getsize(part_file), file_size))
+
+    def download_many(self, urls, session=None, workers=4, name=None, segments=1, validators=None):
+        # Prepare session
+        if session:
+            session_ = session
+        else:
+            session_ = requests.session()
+
+        # One pooled connection per worker and segment
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers * segments)
+        session_.mount('http://', adapter)
+        session_.mount('https://', adapter)
+
+        results = []
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for url in dict.fromkeys(urls):
+                # Links to the same file share one transfer, two workers would race on its .part
+                output_file = os.path.join(self.download_folder, name(url) if name else url.split('/')[-1])
+                if output_file not in futures:
+                    futures[output_file] = executor.submit(self.download, url, session_, name(url) if name else None, segments=segments, validators=validators(url) if validators else None)
+
+                results.append({
+                    'url': url,
+                    'future': futures[output_file]
+                })
+
+        # Collect errors per file
+        for result in results:
+            try:
+                result['transfer'] = result['future'].result()
+                result['error'] = None
+            except Exception as e:
+                result['transfer'] = None
+                result['error'] = e
+            del result['future']
+
+        # End the progress line
+        if self.progress:
+            self.report(force=True)
+            print(file=sys.stderr)
+
+        return results
+
 
 class ExamRegistration():
     endpoints = {
@@ -125,9 +520,13 @@ class ExamRegistration():
         'exams_list': 'http://studente.unimi.it/foIscrizioneEsami/esamiPack/EsamiNonSostenutiDelCorsoPage',
     }
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, session_file=SESSION_FILE):
         self.username = username
         self.password = password
+        self.session_file = session_file
+
+        # How far ahead the server clock is, estimated once before it is needed
+        self.offset = None
 
         # Prepare session
         self.session = requests.session()
@@ -135,6 +534,14 @@ class ExamRegistration():
         self.session.headers = headers
         self.session.verify = VERIFY_ENABLED
 
+        # Reuse the session of a previous run while it is still valid
+        if self.session_file and self.load_session() and self.is_logged_in():
+            self.save_session()
+            return
+
+        self.start_session()
+
+    def start_session(self):
         # Login
         self.login(self.endpoints['exams'])
 
@@ -142,6 +549,54 @@ class ExamRegistration():
         r = self.session.get(self.endpoints['exams'] + 'checkLogin.asp?1-1.ILinkListener-itLink')
         r.raise_for_status()
 
+        if self.session_file:
+            self.save_session()
+
+    def load_session(self):
+        try:
+            with open(self.session_file, 'r') as f:
+                cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+        # Never hand someone else's session to this user
+        if cache.get('username') != self.username:
+            return False
+
+        for cookie in cache.get('cookies', []):
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'], expires=cookie['expires'], secure=cookie['secure'])
+
+        return len(self.session.cookies) != 0
+
+    def save_session(self):
+        cache = {
+            'username': self.username,
+            'saved': time.time(),
+            'cookies': [{
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'expires': cookie.expires,
+                'secure': cookie.secure
+            } for cookie in self.session.cookies]
+        }
+
+        # Readable by the owner only, the cookies are as good as the password
+        fd = os.open(self.session_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.chmod(self.session_file + '.tmp', 0o600)
+        os.replace(self.session_file + '.tmp', self.session_file)
+
+    def is_logged_in(self):
+        # Expired sessions are sent back to CAS
+        r = self.session.get(self.endpoints['exams'], allow_redirects=False)
+        if r.is_redirect:
+            return urlsplit(urljoin(r.url, r.headers['Location'])).netloc != urlsplit(self.endpoints['login']).netloc
+
+        return r.status_code == 200
+
     def login(self, service):
         # Get execution flow
         execution_flow = self.get_execution_flow()
@@ -173,125 +628,211 @@ class ExamRegistration():
         r = self.session.get(self.endpoints['login'])
         r.raise_for_status()
 
-        soup = BeautifulSoup(r.content, features=SOUP_PARSER)
-        value = soup.find('input', {'id': 'hExecution', 'name': 'execution'})
-
-        if value == None:
-            raise ValueError('Cannot find \'execution\' value.')
+        value = parse(r.content, extract_execution_flow)
 
         self.session.cookies.clear()
 
-        return value['value']
+        return value
 
-    def get_exams(self):
-        exams = []
+    def get_exams(self, workers=4):
+        exams, pagination = self.get_exams_page(self.endpoints['exams_list'])
 
-        queue = [self.endpoints['exams_list']]
+        pages = {pagination['page']: exams}
+        known = dict(pagination['pages'])
+        next_pages = {pagination['page']: pagination['next']}
 
-        while len(queue) > 0:
-            current = queue.pop()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # Pagers without page numbers, or showing only a window of them, still link the next page
+                last = max(pages)
+                if next_pages[last] and last + 1 not in known:
+                    known[last + 1] = next_pages[last]
 
-            r = self.session.get(current)
-            r.raise_for_status()
+                # Every page the pager links to, all at once
+                pending = {number: url for number, url in known.items() if number not in pages}
+                if len(pending) == 0:
+                    break
 
-            soup = BeautifulSoup(r.content, features=SOUP_PARSER)
+                mismatch = False
+                futures = {executor.submit(self.get_exams_page, url): number for number, url in pending.items()}
+                for future in concurrent.futures.as_completed(futures):
+                    number = futures[future]
+                    exams, pagination = future.result()
 
-            entries = soup.find('table', {'class': 'smart-table'}).find('tbody').find_all('tr')
-            for entry in entries:
-                code = entry.find_all('td')[0].text.strip()
-                name = entry.find_all('td')[1].text.strip()
-                credits = entry.find_all('td')[2].text.strip()
-                link = urljoin(current, entry.find_all('td')[3].find('a').get('href'))
+                    # Pager links belong to one render of the page, the portal can answer with another page
+                    if pagination['page'] != number:
+                        mismatch = True
+                        continue
 
-                exams.append({
-                    'code': code,
-                    'name': name,
-                    'credits': int(credits),
-                    'link': link
-                })
+                    pages[number] = exams
+                    next_pages[number] = pagination['next']
+                    for x, url in pagination['pages'].items():
+                        known.setdefault(x, url)
 
+                if mismatch:
+                    return self.get_exams_serial()
 
-            next_page = soup.find('ul', {'class': 'pagination'}).find('a', {'title': 'Go to next page'})
-            if next_page:
-                queue.append(urljoin(current, next_page.get('href')))
+        # Merge in page order
+        return [exam for number in sorted(pages) for exam in pages[number]]
 
+    def get_exams_serial(self):
+        # One page at a time, following the next link of the page just rendered
+        exams = []
+
+        current = self.endpoints['exams_list']
+        while current:
+            page, pagination = self.get_exams_page(current)
+            exams.extend(page)
+            current = pagination['next']
 
         return exams
 
+    def get_exams_page(self, url):
+        r = self.session.get(url)
+        r.raise_for_status()
+
+        # Only the table and the pager are needed
+        return parse(r.content, extract_exams, url, only=EXAMS_FRAGMENTS)
+
     def get_exams_dates(self, exam):
         current = exam['link']
 
-        exam_sessions = []
-
         r = self.session.get(current)
         r.raise_for_status()
 
-        soup = BeautifulSoup(r.content, features=SOUP_PARSER)
+        return parse(r.content, extract_exam_sessions, current)
 
-        entries = soup.find('ul', {'role': 'list'}).find_all('li')
-        for index, entry in enumerate(entries):
-            date = entry.find('div', {'class': 'panel-heading'}).find_all('span')[-1].text.strip()
+    def poll_exams_dates(self, exam, cache):
+        # Conditional request when the portal sent validators before
+        headers_ = {}
+        if cache.get('etag'):
+            headers_['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers_['If-Modified-Since'] = cache['last_modified']
 
-            body = entry.find('div', {'class': 'panel-body'})
+        r = self.session.get(exam['link'], headers=headers_)
+        if r.status_code == 304 and 'sessions' in cache:
+            return cache['sessions'], False
 
-            # Check if disabled
-            active = body.find('span', {'role': 'link'}) is None
+        r.raise_for_status()
+
+        # Wicket numbers every render in its links, mask that so only real changes get parsed
+        digest = hashlib.sha256(re.sub(rb'\?[0-9]+-[0-9]+\.', b'?', r.content)).hexdigest()
+        if digest == cache.get('digest'):
+            return cache['sessions'], False
+
+        cache['sessions'] = parse(r.content, extract_exam_sessions, exam['link'])
+        cache['digest'] = digest
+        cache['etag'] = r.headers.get('ETag')
+        cache['last_modified'] = r.headers.get('Last-Modified')
+
+        return cache['sessions'], True
+
+    def get_calendar(self, exams=None, workers=4):
+        if exams is None:
+            exams = self.get_exams(workers)
+
+        # One pooled connection per worker, never more requests in flight than that
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        calendar = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for exam in exams:
+                calendar.append({
+                    'exam': exam,
+                    'future': executor.submit(self.get_exams_dates, exam)
+                })
 
-            # Check if need to compile
-            need_compilation = 'necessario compilare il questionario' in body.text
-            can_register = active and 'Iscriviti' in body.text
-            action = None
+        # Collect errors per exam
+        for entry in calendar:
+            try:
+                entry['sessions'] = entry['future'].result()
+                entry['error'] = None
+            except Exception as e:
+                entry['sessions'] = []
+                entry['error'] = e
+            del entry['future']
 
-            # States
-            # compilation and active = COMPILARE QUESTIONARIO
-            # active and can_register = CAN REGISTER
-            # can_register = ALREADY REGISTERED
-            # TODO: Check if active based on date
+        return calendar
 
-            if need_compilation or can_register:
-                action = urljoin(current, body.find('a', {'role': 'link'}).get('href'))
+    def register_exam_session(self, exam, at=None):
+        return self.finish_registration(self.stage_registration(exam), at)
 
-            exam_sessions.append({
-                'date': date,
-                'active': active,
-                'compile': need_compilation,
-                'register': can_register,
-                'action': action
-            })
+    def finish_registration(self, staged, at=None):
+        # Sampling takes seconds, never spend them once the instant has passed
+        offset = self.offset or 0.0
+        if at is not None and self.offset is None and time.time() < at:
+            offset = self.clock_offset()
 
-            # t = self.session.get(urljoin(r.url, '../esame/selezioneAppello?{}-1.IBehaviorListener.0-form-appelli-{}-detailLink'.format(r.url.split('?')[1], index)), headers=merge_two_dicts(self.session.headers, {
-            #     'Wicket-Ajax-BaseURL': '',
-            #     'Wicket-Ajax': 'true'
-            # }))
-            # print(t.content)
+        r, fired, latency = self.submit_registration(staged, at, offset)
 
-        return exam_sessions
+        # Only parsed once the registration went through
+        receipt = parse(r.content, extract_receipt, r.url)
+        receipt['registered'] = staged['registered']
+        receipt['fired'] = fired + offset
+        receipt['latency'] = latency
 
-    def register_exam_session(self, exam):
+        return receipt
+
+    def stage_registration(self, exam):
         if not exam.get('action'):
             raise ValueError('You cannot register to this session.')
 
         r = self.session.get(exam.get('action'))
         r.raise_for_status()
 
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find('form')
-        hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-
-        users_registered = int(re.search(r'Al momento risultano iscritti ([0-9]+) studenti', form.find('tr', {'class': 'wicketExtensionsWizardViewRow'}).text).group(1))
-
-        r = self.session.post(form_action, data={hidden_id: '', 'wizard:form:buttons:finish': 'Finish'})
+        # Everything the finish POST needs, ready ahead of time
+        staged = parse(r.content, extract_registration_form, r.url)
+        staged['data'] = {staged['hidden_id']: '', 'wizard:form:buttons:finish': 'Finish'}
+
+        return staged
+
+    def clock_offset(self, samples=8):
+        # Date has a one second resolution, every sample is aimed at the
+        # second boundary of the current estimate to halve the uncertainty
+        low, high = float('-inf'), float('inf')
+        for i in range(samples):
+            if low != float('-inf'):
+                estimate = (low + high) / 2
+                sleep_until(int(time.time() + estimate + 0.05) + 1 - estimate)
+
+            sent = time.time()
+            r = self.session.head(self.endpoints['exams'], allow_redirects=False)
+            received = time.time()
+
+            if not r.headers.get('Date'):
+                continue
+
+            server = email.utils.parsedate_to_datetime(r.headers['Date']).timestamp()
+            low = max(low, server - received)
+            high = min(high, server + 1 - sent)
+
+        self.offset = (low + high) / 2 if low != float('-inf') else 0.0
+
+        return self.offset
+
+    def submit_registration(self, staged, at=None, offset=0.0, warm_up=2.0, keep_alive=60):
+        # at is in server time, offset is how far ahead the server clock is
+        if at is not None:
+            # The staged form lives as long as the portal session, keep it in use
+            while at - offset - time.time() > warm_up + keep_alive:
+                time.sleep(keep_alive)
+                self.session.head(self.endpoints['exams'], allow_redirects=False)
+
+            # Reopen an idle connection before the instant, not on it
+            sleep_until(at - offset - warm_up)
+            self.session.head(self.endpoints['exams'], allow_redirects=False)
+            sleep_until(at - offset)
+
+        fired = time.time()
+        start_time = time.perf_counter()
+        r = self.session.post(staged['action'], data=staged['data'])
+        latency = time.perf_counter() - start_time
         r.raise_for_status()
 
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        qr_code = urljoin(r.url, soup.find('form').find('div', {'class': 'row'}).find('img').get('src'))
-        pdf = urljoin(r.url, soup.find('form').find('a').get('href'))
-
-        return {
-            'qr': qr_code,
-            'pdf': pdf
-        }
+        return r, fired, latency
 
     def complete_survey(self, exam):
         if not exam.get('action'):
@@ -300,126 +841,362 @@ class ExamRegistration():
         # Home
         r = self.session.get(exam.get('action'))
         r.raise_for_status()
-        
-        # Next button
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={hidden_id: '', 'avantiButton': 'next'})
-        r.raise_for_status()
 
-        # Next button
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={hidden_id: '', 'avantiButton': 'next'})
-        r.raise_for_status()
+        return run_form_steps(self.session, r, SURVEY_STEPS)
 
-        # Skip button
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
 
-        # Select course
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'view:form:content:form:insegnamentiTable:body:rows:1:cells:4:cell:button': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
+def parse(content, extract, *args, parsers=None, only=None):
+    # Imported on first use, bs4 loads every tree builder it can find
+    from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
 
-        # Frequency
-        # 0 Mai
-        # 1 Piu' di due anni fa
-        # 2 Due anni fa
-        # 3 Lo scorso anno accademico
-        # 4 In quest'anno accademico
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'view:form:content:form:frequentazione': 4, 'buttons:next': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
+    # Fast parsers first, html5lib repairs malformed pages the way browsers do
+    error = None
+    for parser in parsers or SOUP_PARSERS:
+        try:
+            # Build only the fragments matching only, html5lib always builds the whole tree
+            if only and parser != 'html5lib':
+                soup = BeautifulSoup(content, parser, parse_only=SoupStrainer(**only))
+            else:
+                soup = BeautifulSoup(content, parser)
+        except FeatureNotFound as e:
+            error = e
+            continue
 
-        # Frequency percentage
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'view:form:content:form:frequenzaSlider:model:input': 50, 'view:form:content:form:frequenzaText': 50, 'buttons:next': 'BRUH'})
-        r.raise_for_status()
+        try:
+            return extract(soup, *args)
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+            error = e
 
-        # Next button
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'buttons:next': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
+    raise error
 
-        # Next button
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'buttons:next': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
 
+def extract_execution_flow(soup):
+    value = soup.find('input', {'id': 'hExecution', 'name': 'execution'})
 
-        # First section (Motivo della non frequenza)
-        # 1. Indicare il motivo principale della non frequenza o della frequenza ridotta alle lezioni: (*)
-        # "1" "Frequenza alle lezioni dell'insegnamento in un altro anno accademico"
-        # "2" "Lavoro"
-        # "3" "Frequenza lezioni di altri insegnamenti"
-        # "4" "Frequenza poco utile ai fini della preparazione dell'esame"
-        # "5" "La logistica delle aule non consente la frequenza agli studenti interessati"
-        # "6" "Altro"
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'jsonField': '{"D1":"6"}', 'avantiButton': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
+    if value == None:
+        raise ValueError('Cannot find \'execution\' value.')
 
-        # Second section (Insegnamento)
-        # 1. Le conoscenze preliminari possedute sono risultate sufficienti per la comprensione degli argomenti previsti nel programma d'esame? (*)
-        # {"D2":"2","D3":"2","D5a":"2","D5b":"1","D6":"2","D7":"2","D8":"2","D9":"2"}
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'jsonField': '{"D2":"2","D3":"2","D5a":"2","D5b":"1","D6":"2","D7":"2","D8":"2","D9":"2"}', 'avantiButton': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
+    return value['value']
 
-        # Third section (Docente/i)
-        # 1. Il docente è reperibile per chiarimenti e spiegazioni? (*)
-        # D10
-        # "2" "Decisamente NO"
-        # "5" "Più NO che Sì"
-        # "7" "Più Sì che No"
-        # "10" "Decisamente Sì"
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'jsonField': '{"D10":"2"}', 'avantiButton': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
-        r.raise_for_status()
 
-        # Fourth section (Suggerimenti)
-        # 1. Indichi eventuali suggerimenti per migliorare la qualità dell'insegnamento che sta valutando
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        form = soup.find_all('form')[1]
-        #hidden_id = form.find('input', {'type': 'hidden'}).get('name')
-        form_action = urljoin(r.url, form.get('action'))
-        r = self.session.post(form_action, data={'jsonField': '{"D11":["8","6"]}', 'fineQuestionarioButton': 'BRUH'})# data={hidden_id: '', 'skipButton': 'next'})
+# Fragments of the exams list extract_exams reads, class is still a plain string while straining
+EXAMS_FRAGMENTS = {'class_': re.compile(r'(^|\s)(smart-table|pagination)(\s|$)')}
+
+
+def extract_exams(soup, url):
+    exams = []
+
+    entries = soup.find('table', {'class': 'smart-table'}).find('tbody').find_all('tr')
+    for entry in entries:
+        td = entry.find_all('td')
+
+        exams.append({
+            'code': td[0].text.strip(),
+            'name': td[1].text.strip(),
+            'credits': int(td[2].text.strip()),
+            'link': urljoin(url, td[3].find('a').get('href'))
+        })
+
+    # Single pages have no pager
+    pagination = {'page': 1, 'pages': {}, 'next': None}
+
+    pager = soup.find('ul', {'class': 'pagination'})
+    if pager:
+        active = pager.find('li', {'class': 'active'})
+        if active and active.text.strip().isdigit():
+            pagination['page'] = int(active.text.strip())
+
+        for a in pager.find_all('a', title=re.compile(r'^Go to page [0-9]+$')):
+            pagination['pages'][int(a.get('title').split()[-1])] = urljoin(url, a.get('href'))
+
+        next_page = pager.find('a', {'title': 'Go to next page'})
+        if next_page:
+            pagination['next'] = urljoin(url, next_page.get('href'))
+
+    return exams, pagination
+
+
+def extract_exam_sessions(soup, url):
+    exam_sessions = []
+
+    entries = soup.find('ul', {'role': 'list'}).find_all('li')
+    for index, entry in enumerate(entries):
+        date = entry.find('div', {'class': 'panel-heading'}).find_all('span')[-1].text.strip()
+
+        body = entry.find('div', {'class': 'panel-body'})
+
+        # Check if disabled
+        active = body.find('span', {'role': 'link'}) is None
+
+        # Check if need to compile
+        need_compilation = 'necessario compilare il questionario' in body.text
+        can_register = active and 'Iscriviti' in body.text
+        action = None
+
+        # States
+        # compilation and active = COMPILARE QUESTIONARIO
+        # active and can_register = CAN REGISTER
+        # can_register = ALREADY REGISTERED
+        # TODO: Check if active based on date
+
+        if need_compilation or can_register:
+            action = urljoin(url, body.find('a', {'role': 'link'}).get('href'))
+
+        exam_sessions.append({
+            'date': date,
+            'active': active,
+            'compile': need_compilation,
+            'register': can_register,
+            'action': action
+        })
+
+        # t = self.session.get(urljoin(r.url, '../esame/selezioneAppello?{}-1.IBehaviorListener.0-form-appelli-{}-detailLink'.format(r.url.split('?')[1], index)), headers=merge_two_dicts(self.session.headers, {
+        #     'Wicket-Ajax-BaseURL': '',
+        #     'Wicket-Ajax': 'true'
+        # }))
+        # print(t.content)
+
+    return exam_sessions
+
+
+def extract_registration_form(soup, url):
+    form = soup.find('form')
+
+    return {
+        'hidden_id': form.find('input', {'type': 'hidden'}).get('name'),
+        'action': urljoin(url, form.get('action')),
+        'registered': int(re.search(r'Al momento risultano iscritti ([0-9]+) studenti', form.find('tr', {'class': 'wicketExtensionsWizardViewRow'}).text).group(1))
+    }
+
+
+def extract_receipt(soup, url):
+    form = soup.find('form')
+
+    return {
+        'qr': urljoin(url, form.find('div', {'class': 'row'}).find('img').get('src')),
+        'pdf': urljoin(url, form.find('a').get('href'))
+    }
+
+
+def extract_survey_form(soup, url):
+    # The first form is the page header
+    form = soup.find_all('form')[1]
+    hidden = form.find('input', {'type': 'hidden'})
+
+    return {
+        'hidden_id': hidden.get('name') if hidden else None,
+        'action': urljoin(url, form.get('action'))
+    }
+
+
+# Only the forms are built, extract_survey_form reads nothing else
+SURVEY_FRAGMENTS = {'name': 'form'}
+
+# Every step posts to the action of the form on the current page, with the
+# hidden field Wicket expects when the third value is True
+SURVEY_STEPS = [
+    ('next', {'avantiButton': 'next'}, True),
+    ('next', {'avantiButton': 'next'}, True),
+    ('skip', {'skipButton': 'next'}, True),
+    ('course', {'view:form:content:form:insegnamentiTable:body:rows:1:cells:4:cell:button': 'BRUH'}, False),
+
+    # Frequency
+    # 0 Mai
+    # 1 Piu' di due anni fa
+    # 2 Due anni fa
+    # 3 Lo scorso anno accademico
+    # 4 In quest'anno accademico
+    ('frequency', {'view:form:content:form:frequentazione': 4, 'buttons:next': 'BRUH'}, False),
+    ('percentage', {'view:form:content:form:frequenzaSlider:model:input': 50, 'view:form:content:form:frequenzaText': 50, 'buttons:next': 'BRUH'}, False),
+    ('next', {'buttons:next': 'BRUH'}, False),
+    ('next', {'buttons:next': 'BRUH'}, False),
+
+    # First section (Motivo della non frequenza)
+    # 1. Indicare il motivo principale della non frequenza o della frequenza ridotta alle lezioni: (*)
+    # "1" "Frequenza alle lezioni dell'insegnamento in un altro anno accademico"
+    # "2" "Lavoro"
+    # "3" "Frequenza lezioni di altri insegnamenti"
+    # "4" "Frequenza poco utile ai fini della preparazione dell'esame"
+    # "5" "La logistica delle aule non consente la frequenza agli studenti interessati"
+    # "6" "Altro"
+    ('absence', {'jsonField': '{"D1":"6"}', 'avantiButton': 'BRUH'}, False),
+
+    # Second section (Insegnamento)
+    # 1. Le conoscenze preliminari possedute sono risultate sufficienti per la comprensione degli argomenti previsti nel programma d'esame? (*)
+    # {"D2":"2","D3":"2","D5a":"2","D5b":"1","D6":"2","D7":"2","D8":"2","D9":"2"}
+    ('teaching', {'jsonField': '{"D2":"2","D3":"2","D5a":"2","D5b":"1","D6":"2","D7":"2","D8":"2","D9":"2"}', 'avantiButton': 'BRUH'}, False),
+
+    # Third section (Docente/i)
+    # 1. Il docente è reperibile per chiarimenti e spiegazioni? (*)
+    # D10
+    # "2" "Decisamente NO"
+    # "5" "Più NO che Sì"
+    # "7" "Più Sì che No"
+    # "10" "Decisamente Sì"
+    ('teacher', {'jsonField': '{"D10":"2"}', 'avantiButton': 'BRUH'}, False),
+
+    # Fourth section (Suggerimenti)
+    # 1. Indichi eventuali suggerimenti per migliorare la qualità dell'insegnamento che sta valutando
+    ('suggestions', {'jsonField': '{"D11":["8","6"]}', 'fineQuestionarioButton': 'BRUH'}, False),
+]
+
+
+def run_form_steps(session, r, steps, extract=extract_survey_form, parsers=None, only=SURVEY_FRAGMENTS, timings=None):
+    # Read the form off the current page and post the step to it, timings gets parse and request seconds of every step
+    for name, data, hidden in steps:
+        start_time = time.perf_counter()
+        form = parse(r.content, extract, r.url, parsers=parsers, only=only)
+        parsed = time.perf_counter()
+
+        if hidden:
+            data = merge_two_dicts({form['hidden_id']: ''}, data)
+
+        r = session.post(form['action'], data=data)
         r.raise_for_status()
 
-        return r
+        if timings is not None:
+            timings.append({'step': name, 'parse': parsed - start_time, 'request': time.perf_counter() - parsed})
+
+    return r
+
+
+def sleep_until(instant):
+    # Sleep most of the way, then spin for the last few milliseconds
+    while True:
+        remaining = instant - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - 0.005 if remaining > 0.01 else 0)
+
+
+def poll_interval(now, opens_at, minimum, maximum):
+    # Tight around the expected opening, a tenth of the distance from it otherwise
+    if opens_at is None:
+        return maximum
+
+    return min(max(abs(opens_at - now) / 10, minimum), maximum)
+
+
+def watch(unimi, exams, opens_at=None, minimum=5, maximum=300, auto_register=False, events=sys.stdout, at=None):
+    # Keyed by code, links change with every portal session
+    caches = {exam['code']: {} for exam in exams}
+    last_poll = {}
+    polls = 0
+    failures = 0
+    reported = set()
+
+    def emit(event):
+        events.write(json.dumps(event, ensure_ascii=False) + '\n')
+        events.flush()
+
+    # Before polling, sessions often open right at the instant and the POST must not wait for it
+    if auto_register and at is not None and unimi.offset is None:
+        unimi.clock_offset()
+
+    while len(exams) > 0:
+        polls += 1
+        for exam in list(exams):
+            try:
+                sessions, changed = unimi.poll_exams_dates(exam, caches[exam['code']])
+            except Exception as e:
+                print('Failed: {} ({})'.format(exam['name'], e), file=sys.stderr)
+
+                try:
+                    # Long watches outlive the portal session, and its links with it
+                    if not unimi.is_logged_in():
+                        unimi.start_session()
+
+                        current = {x['code']: x for x in unimi.get_exams()}
+                        exams[:] = [current.get(x['code'], x) for x in exams]
+                        failures = 0
+                        break
+                except Exception as e:
+                    failures += 1
+                    print('Failed to log in again ({})'.format(e), file=sys.stderr)
+                    break
+                continue
+
+            failures = 0
+            detected = time.time()
+            window = detected - last_poll[exam['code']] if exam['code'] in last_poll else None
+            last_poll[exam['code']] = detected
+
+            if not changed:
+                continue
+
+            for exam_session in sessions:
+                key = (exam['code'], exam_session['date'])
+                if not (exam_session['active'] and (exam_session['register'] or exam_session['compile'])) or key in reported:
+                    continue
+                reported.add(key)
+
+                # Latency from the expected opening, the change happened within window
+                emit({
+                    'event': 'open',
+                    'code': exam['code'],
+                    'exam': exam['name'],
+                    'date': exam_session['date'],
+                    'register': exam_session['register'],
+                    'compile': exam_session['compile'],
+                    'action': exam_session['action'],
+                    'detected': datetime.fromtimestamp(detected).isoformat(),
+                    'latency': detected - opens_at if opens_at else None,
+                    'window': window,
+                    'polls': polls
+                })
+
+                if auto_register:
+                    try:
+                        # Staged as soon as it opens, finished now or at the given instant
+                        staged = stage_when_open(unimi, exam, exam_session)
+                        emit({
+                            'event': 'staged',
+                            'code': exam['code'],
+                            'exam': exam['name'],
+                            'date': exam_session['date'],
+                            'registered': staged['registered'],
+                            'at': datetime.fromtimestamp(at).isoformat() if at else None
+                        })
+                        result = unimi.finish_registration(staged, at)
+                    except Exception as e:
+                        # Fetch and parse the page again on the next poll and retry, validators would get a 304
+                        emit({'event': 'error', 'code': exam['code'], 'exam': exam['name'], 'date': exam_session['date'], 'error': str(e)})
+                        reported.discard(key)
+                        caches[exam['code']].clear()
+                        break
+
+                    emit({
+                        'event': 'registered',
+                        'code': exam['code'],
+                        'exam': exam['name'],
+                        'date': exam_session['date'],
+                        'pdf': result['pdf'],
+                        'latency': time.time() - opens_at if opens_at else None,
+                        'submit_latency': result['latency']
+                    })
+                    exams.remove(exam)
+                    yield exam, exam_session, result
+                    break
+
+        if len(exams) > 0:
+            # Back off while the portal or the network is down
+            if failures:
+                time.sleep(min(minimum * 2 ** failures, maximum))
+            else:
+                time.sleep(poll_interval(time.time(), opens_at, minimum, maximum))
+
+
+def stage_when_open(unimi, exam, exam_session):
+    if exam_session['register']:
+        return unimi.stage_registration(exam_session)
+
+    # The survey comes first, then the session offers registration
+    unimi.complete_survey(exam_session)
+    for current in unimi.get_exams_dates(exam):
+        if current['date'] == exam_session['date']:
+            return unimi.stage_registration(current)
+
+    raise ValueError('Session of {} disappeared after the survey.'.format(exam_session['date']))
 
 
 def default_format(entry):
@@ -459,11 +1236,81 @@ def merge_two_dicts(x, y):
     return z
 
 
+def calendar_rows(calendar):
+    for entry in calendar:
+        for exam_session in entry['sessions']:
+            yield {
+                'code': entry['exam']['code'],
+                'exam': entry['exam']['name'],
+                'credits': entry['exam']['credits'],
+                'date': exam_session['date'],
+                'active': exam_session['active'],
+                'compile': exam_session['compile'],
+                'register': exam_session['register'],
+                'action': exam_session['action']
+            }
+
+
+def write_calendar(calendar, path):
+    rows = list(calendar_rows(calendar))
+
+    # CSV by extension, JSON otherwise, - is stdout
+    f = sys.stdout if path == '-' else open(path, 'w', newline='')
+    try:
+        if path.endswith('.csv'):
+            writer = csv.DictWriter(f, fieldnames=['code', 'exam', 'credits', 'date', 'active', 'compile', 'register', 'action'])
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            json.dump(rows, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    return rows
+
+
 def main(args):
     downloader = Downloader('receipts')
-    unimi = ExamRegistration(args.username, args.password)
-
-    exams = unimi.get_exams()
+    unimi = ExamRegistration(args.username, args.password, None if args.no_session_cache else args.session_file)
+
+    exams = unimi.get_exams(args.workers)
+
+    # Finish the registration at a given instant of the server clock
+    at = datetime.fromisoformat(args.at).timestamp() if args.at else None
+
+    # Wait for sessions of the chosen exams to open
+    if args.watch:
+        watched = [x for x in exams if x['code'] in args.watch or any(y.lower() in x['name'].lower() for y in args.watch)]
+        if len(watched) == 0:
+            print('None of {} found among your exams.'.format(', '.join(args.watch)))
+            sys.exit(1)
+
+        opens_at = datetime.fromisoformat(args.opens_at).timestamp() if args.opens_at else at
+        events = open(args.events, 'a') if args.events else sys.stdout
+        try:
+            for exam, exam_session, result in watch(unimi, watched, opens_at, args.interval_min, args.interval_max, args.auto_register, events, at):
+                if args.pdf:
+                    downloader.download(result['pdf'], session=unimi.session, name='{}{}_{}.pdf'.format(exam['code'], slugify(exam['name']), slugify(exam_session['date'])))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if events is not sys.stdout:
+                events.close()
+        return
+
+    # Snapshot of every session of every exam, no registration
+    if args.calendar:
+        calendar = unimi.get_calendar(exams, args.workers)
+        for entry in calendar:
+            if entry['error']:
+                print('Failed: {} ({})'.format(entry['exam']['name'], entry['error']), file=sys.stderr)
+
+        rows = write_calendar(calendar, args.calendar)
+        if args.calendar != '-':
+            print('{} sessions of {} exams written to "{}".'.format(len(rows), len(exams), args.calendar))
+        return
 
     exam = choose_from_list('Choose an exam', list_=exams, format_=lambda e: e.get('name'))
 
@@ -472,17 +1319,24 @@ def main(args):
     exam_session = choose_from_list('Choose an exam session', list_=exam_sessions, format_=lambda e: '{} [{}]'.format(e.get('date'), e.get('action')))
 
     if exam_session['active'] and exam_session['register']:
-        result = unimi.register_exam_session(exam_session)
+        result = unimi.register_exam_session(exam_session, at)
     elif exam_session['active'] and exam_session['compile']:
         # Need to compile survey
         result = unimi.complete_survey(exam_session)
         exam_sessions = unimi.get_exams_dates(exam)
         exam_session = choose_from_list('Choose an exam session', list_=exam_sessions, format_=lambda e: '{} [{}]'.format(e.get('date'), e.get('action')))
-        result = unimi.register_exam_session(exam_session)
+        result = unimi.register_exam_session(exam_session, at)
+    elif at is not None:
+        print('This exam session is not open yet, stage it when it opens with --watch {} --auto-register --at {}. Exiting...'.format(exam['code'], args.at))
+        sys.exit(1)
     else:
         print('You cannot register to this exam session. Exiting...')
         sys.exit(1)
 
+    print('Registered ({} students before you), submit took {:.0f}ms.'.format(result['registered'], result['latency'] * 1000))
+    if at is not None:
+        print('Fired at {} server time, {:+.0f}ms from the target.'.format(datetime.fromtimestamp(result['fired']).isoformat(), (result['fired'] - at) * 1000))
+
     # Download PDF receipt
     if args.pdf:
         downloader.download(result['pdf'], session=unimi.session, name='{}{}_{}.pdf'.format(exam['code'], slugify(exam['name']), slugify(exam_session['date'])))
@@ -493,6 +1347,17 @@ if __name__ == '__main__':
     parser.add_argument('username', help='your @studenti.unimi.it email')
     parser.add_argument('password', help='your @studenti.unimi.it password')
     parser.add_argument('-p', '--pdf', help='save pdf receipt', action='store_true')
+    parser.add_argument('-c', '--calendar', help='write all exam sessions to a JSON or .csv file (- for stdout) and exit')
+    parser.add_argument('-w', '--workers', help='pages fetched in parallel', type=int, default=4)
+    parser.add_argument('--at', help='finish the staged registration at this server time, e.g. 2021-06-01T09:00:00, with --watch sessions are staged as soon as they open')
+    parser.add_argument('--watch', help='exam codes or names to watch for sessions opening', nargs='+')
+    parser.add_argument('--opens-at', help='expected opening, e.g. 2021-06-01T09:00, polling is tightest around it')
+    parser.add_argument('--interval-min', help='shortest seconds between polls', type=float, default=5)
+    parser.add_argument('--interval-max', help='longest seconds between polls', type=float, default=300)
+    parser.add_argument('--auto-register', help='register as soon as a watched session opens', action='store_true')
+    parser.add_argument('--events', help='append watch events as JSON lines to a file instead of stdout')
+    parser.add_argument('--session-file', help='where the logged in session is cached', default=SESSION_FILE)
+    parser.add_argument('--no-session-cache', help='always log in from scratch', action='store_true')
     # TODO: Add --all logic
     # parser.add_argument('--all', help='register on all available exam sessions', action='store_true')
     main(parser.parse_args())
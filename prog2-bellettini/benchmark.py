@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Giacomo Ferretti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import re
+import time
+import hashlib
+import argparse
+import subprocess
+import tempfile
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from bulk_download import Downloader, SOUP_PARSERS, parse, extract_lessons
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Entry point of the startup benchmark
+MODULE = 'bulk_download'
+
+# Modules only some code paths need, they must not load at startup
+HEAVY_MODULES = ['bs4', 'html5lib', 'lxml', 'youtube_dl']
+
+
+class FileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data, latency=0.0, rate=0.0, connections=None):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.data = data
+        self.latency = latency
+        self.rate = rate
+        self.connections = connections
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on idle keep-alive connections
+        pass
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body go out in separate writes, Nagle would hold the body for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        if self.server.connections is not None:
+            with self.server.connections.get_lock():
+                self.server.connections.value += 1
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = 0, len(data) - 1
+
+        # Round trip before the first byte
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        match = re.match(r'bytes=([0-9]+)-([0-9]*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end + 1 - start))
+        self.end_headers()
+
+        # Throttle every connection on its own, like a long fat network does
+        view = memoryview(data)[start:end + 1]
+        block = 65536
+        for i in range(0, len(view), block):
+            self.wfile.write(view[i:i + block])
+            if self.server.rate:
+                time.sleep(block / self.server.rate)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(block, size, latency, rate, port, connections):
+    server = FileServer(block * size, latency, rate, connections)
+    port.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_server(size, latency=0.0, rate=0.0):
+    # Separate process, so its CPU time is not measured
+    block = os.urandom(1024 * 1024)
+    port = multiprocessing.Queue()
+    connections = multiprocessing.Value('i', 0)
+    process = multiprocessing.Process(target=serve, args=(block, size, latency, rate, port, connections), daemon=True)
+    process.start()
+
+    url = 'http://127.0.0.1:{}/file.zip'.format(port.get())
+    return url, hashlib.sha256(block * size).digest(), process, connections
+
+
+def legacy_download(url, output_file):
+    # Write path before the tuned one
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        with open(output_file, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=4096):
+                f.write(chunk)
+
+
+def run(url, digest, download):
+    with tempfile.TemporaryDirectory() as tmp:
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        download(tmp, url)
+        elapsed = time.perf_counter() - start_time
+        cpu = time.process_time() - start_cpu
+
+        with open(os.path.join(tmp, 'file.zip'), 'rb') as f:
+            if hashlib.sha256(f.read()).digest() != digest:
+                print('ERROR: downloaded file does not match.')
+                exit(1)
+
+    return elapsed, cpu
+
+
+def bench_segments(args):
+    url, digest, server, _ = start_server(args.size, args.latency, args.rate * 1024 * 1024)
+
+    print('File: {} MiB, latency {:.0f}ms, {} MiB/s per connection'.format(args.size, args.latency * 1000, args.rate or 'unlimited'))
+    print('{:>9} {:>10} {:>10}'.format('segments', 'wall time', 'MiB/s'))
+    for segments in args.segments:
+        elapsed, _ = run(url, digest, lambda tmp, url: Downloader(tmp).download(url, requests.session(), segments=segments))
+        print('{:>9} {:>9.2f}s {:>10.1f}'.format(segments, elapsed, args.size / elapsed))
+
+    server.terminate()
+
+
+def count_connections(connections, download):
+    with connections.get_lock():
+        connections.value = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        download(tmp)
+
+    return connections.value
+
+
+def bench_write(args):
+    url, digest, server, connections = start_server(args.size)
+
+    paths = [('4KiB iter_content (before)', lambda tmp, url: legacy_download(url, os.path.join(tmp, 'file.zip')))]
+    for chunk_size in args.chunk_sizes:
+        label = 'readinto {}'.format('adaptive' if chunk_size == 0 else Downloader.sizeof_fmt(chunk_size * 1024))
+        paths.append((label, lambda tmp, url, chunk_size=chunk_size: Downloader(tmp, chunk_size * 1024 or None).download(url, requests.session())))
+
+    print('File: {} MiB, best of {} runs'.format(args.size, args.repeat))
+    print('{:>28} {:>10} {:>12}'.format('write path', 'MiB/s', 'CPU s/GiB'))
+    for label, download in paths:
+        elapsed, cpu = min(run(url, digest, download) for _ in range(args.repeat))
+        print('{:>28} {:>10.1f} {:>12.2f}'.format(label, args.size / elapsed, cpu / args.size * 1024))
+
+    # The fast write path must still hand connections back to the pool
+    def sequential(tmp):
+        session = requests.session()
+        for _ in range(args.files):
+            Downloader(tmp).download(url, session)
+
+    def parallel(tmp):
+        urls = [url.replace('file.zip', 'file{}.zip'.format(i)) for i in range(args.files)]
+        for result in Downloader(tmp).download_many(urls, requests.session(), workers=args.workers):
+            if result['error']:
+                raise result['error']
+
+    checks = [
+        ('{} downloads, one session'.format(args.files), sequential, 1),
+        ('download_many, {} workers'.format(args.workers), parallel, args.workers)
+    ]
+
+    print()
+    print('{:>28} {:>12} {:>8}'.format('connection reuse', 'connections', 'limit'))
+    failed = False
+    for label, download, limit in checks:
+        count = count_connections(connections, download)
+        print('{:>28} {:>12} {:>8}'.format(label, count, limit))
+        failed = failed or count > limit
+
+    server.terminate()
+
+    if failed:
+        print('ERROR: downloads open a new connection instead of reusing a pooled one.')
+        exit(1)
+
+
+def bench_parse(args):
+    with open(os.path.join(FIXTURES, 'homepage.html'), 'rb') as f:
+        content = f.read()
+
+    # html5lib is the reference, it is what the homepage was always parsed with
+    backends = [('html5lib', ['html5lib'])] + [(x, [x]) for x in args.parsers if x != 'html5lib'] + [('default', SOUP_PARSERS)]
+
+    print('{:>12} {:>10} {:>8}  {}'.format('parser', 'ms/page', 'speedup', 'data'))
+    for label, parsers in backends:
+        try:
+            result = parse(content, extract_lessons, parsers=parsers)
+        except Exception as e:
+            print('{:>12} {:>10} {:>8}  failed ({})'.format(label, '-', '-', type(e).__name__))
+            continue
+
+        start_time = time.perf_counter()
+        for _ in range(args.repeat):
+            parse(content, extract_lessons, parsers=parsers)
+        elapsed = (time.perf_counter() - start_time) / args.repeat
+
+        if label == 'html5lib':
+            reference, baseline = result, elapsed
+
+        print('{:>12} {:>10.2f} {:>7.1f}x  {}'.format(label, elapsed * 1000, baseline / elapsed, 'same' if result == reference else 'DIFFERENT'))
+
+        # The default chain must never change what gets extracted
+        if label == 'default' and result != reference:
+            print('ERROR: the default parsers extract different data than html5lib.')
+            exit(1)
+
+
+def python(args, env):
+    return subprocess.run([sys.executable] + args, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True, check=True)
+
+
+def startup_env(cache):
+    # Bytecode cached outside the tree, like an installed copy, not compiled on every run
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=cache)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def startup_times(codes, repeat, env):
+    # Interleaved, so a busy machine slows every variant alike, best run wins
+    times = [[] for _ in codes]
+    for _ in range(repeat):
+        for i, code in enumerate(codes):
+            start_time = time.perf_counter()
+            python(['-c', code], env)
+            times[i].append(time.perf_counter() - start_time)
+
+    return [min(x) for x in times]
+
+
+def module_time(module, repeat, env):
+    # Cumulative import time of the module alone in us, requests is loaded first so it is not counted
+    times = []
+    for _ in range(repeat):
+        output = python(['-X', 'importtime', '-c', 'import requests; import ' + module], env).stderr
+        times.append(int(re.search(r'import time:\s+[0-9]+ \|\s+([0-9]+) \| {}$'.format(module), output, re.MULTILINE).group(1)))
+
+    return min(times)
+
+
+def import_tree(module, env):
+    # Direct imports of the module and their cumulative time in us, from -X importtime
+    output = python(['-X', 'importtime', '-c', 'import ' + module], env).stderr
+
+    children = []
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+[0-9]+ \|\s+([0-9]+) \|( *)(\S+)$', line)
+        if not match:
+            continue
+
+        depth = len(match.group(2)) // 2
+        if depth == 0 and match.group(3) != module:
+            children = []
+        elif depth == 1:
+            children.append((int(match.group(1)), match.group(3)))
+
+    return sorted(children, reverse=True)
+
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as cache:
+        env = startup_env(cache)
+
+        # The first run writes the bytecode cache
+        python(['-c', 'import ' + MODULE], env)
+
+        python_, requests_, total = startup_times(['pass', 'import requests', 'import ' + MODULE], args.repeat, env)
+        own = module_time(MODULE, args.repeat, env) / 1000
+
+        loaded = python(['-c', 'import sys, {}; print(*sys.modules)'.format(MODULE)], env).stdout.split()
+        heavy = sorted(set(x.split('.')[0] for x in loaded) & set(HEAVY_MODULES))
+
+        tree = import_tree(MODULE, env)
+
+    print('Cold start of {}, best of {} runs'.format(MODULE, args.repeat))
+    print('{:>24} {:>8.1f}ms'.format('python -c pass', python_ * 1000))
+    print('{:>24} {:>8.1f}ms'.format('+ requests', (requests_ - python_) * 1000))
+    print('{:>24} {:>8.1f}ms'.format('+ ' + MODULE, (total - requests_) * 1000))
+    print('{:>24} {:>8.1f}ms (target {}ms)'.format('total', total * 1000, args.target))
+    print('{:>24} {:>8.1f}ms (-X importtime, after requests)'.format('import ' + MODULE, own))
+
+    print()
+    print('Slowest imports of {}:'.format(MODULE))
+    for cumulative, name in tree[:args.top]:
+        print('{:>24} {:>8.1f}ms'.format(name, cumulative / 1000))
+
+    # requests is needed by every entry point, the rest of the startup is ours
+    failed = False
+    if heavy:
+        print('ERROR: {} imported at startup.'.format(', '.join(heavy)))
+        failed = True
+    # Wall time differences are noise, the gate is the import time of the module itself
+    if own > args.budget:
+        print('ERROR: importing {} takes {:.1f}ms on top of requests, budget is {}ms.'.format(MODULE, own, args.budget))
+        failed = True
+
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    segments_parser = subparsers.add_parser('segments', help='single stream against segmented downloads')
+    segments_parser.add_argument('-n', '--size', help='file size in MiB', type=int, default=64)
+    segments_parser.add_argument('-l', '--latency', help='seconds before the first byte of every response', type=float, default=0.05)
+    segments_parser.add_argument('-r', '--rate', help='MiB/s per connection (0 = unlimited)', type=float, default=8)
+    segments_parser.add_argument('-s', '--segments', help='segment counts to compare', type=int, nargs='+', default=[1, 2, 4, 8])
+    segments_parser.set_defaults(func=bench_segments)
+
+    write_parser = subparsers.add_parser('write', help='throughput and CPU cost of the write path')
+    write_parser.add_argument('-n', '--size', help='file size in MiB', type=int, default=256)
+    write_parser.add_argument('-c', '--chunk-sizes', help='chunk sizes in KiB to compare (0 = adaptive)', type=int, nargs='+', default=[0, 64, 1024])
+    write_parser.add_argument('--repeat', help='runs per path', type=int, default=3)
+    write_parser.add_argument('-f', '--files', help='downloads in the connection reuse check', type=int, default=10)
+    write_parser.add_argument('-w', '--workers', help='download_many workers in the connection reuse check', type=int, default=4)
+    write_parser.set_defaults(func=bench_write)
+
+    parse_parser = subparsers.add_parser('parse', help='parse the saved homepage with every backend and compare the extracted data')
+    parse_parser.add_argument('-p', '--parsers', help='BeautifulSoup backends to compare with html5lib', nargs='+', default=['lxml', 'html.parser'])
+    parse_parser.add_argument('--repeat', help='parses per backend', type=int, default=50)
+    parse_parser.set_defaults(func=bench_parse)
+
+    startup_parser = subparsers.add_parser('startup', help='cold start time and heavy imports of {}.py'.format(MODULE))
+    startup_parser.add_argument('--repeat', help='runs per measurement', type=int, default=15)
+    startup_parser.add_argument('--top', help='direct imports to show', type=int, default=8)
+    startup_parser.add_argument('--budget', help='ms allowed on top of importing requests', type=float, default=30)
+    startup_parser.add_argument('--target', help='total cold start to aim for, in ms', type=float, default=100)
+    startup_parser.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
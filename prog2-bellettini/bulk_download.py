@@ -22,10 +22,11 @@ import json
 import urllib
 import argparse
 import pathlib
+import threading
+import http.client
+import concurrent.futures
 
 import requests
-import youtube_dl
-from bs4 import BeautifulSoup
 
 # Config
 VERBOSE           = True
@@ -34,7 +35,11 @@ PROXY_ENABLED     = False
 PROXY_URL         = 'http://localhost:8080'
 VERIFY_ENABLED    = True
 SUPPRESS_WARNINGS = False
-SOUP_PARSER       = 'html5lib'
+SOUP_PARSERS      = ['lxml', 'html5lib']
+MANIFEST_FILE     = 'manifest.json'
+SYNC_FILE         = 'sync.json'
+VIDEO_ARCHIVE     = 'videos.txt'
+VIDEO_FAILURES    = 'videos_failed.json'
 
 # Initaliaze necessary components
 headers = {
@@ -58,7 +63,7 @@ class BellettiniScraper():
         'login': 'https://homes.di.unimi.it/bellettini/down.php'
     }
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, manifest_file=MANIFEST_FILE):
         self.username = username
         self.password = password
         self.auth = (username, password)
@@ -70,61 +75,62 @@ class BellettiniScraper():
         self.session.verify = VERIFY_ENABLED
         self.session.auth = self.auth
 
-        # Test credentials
-        r = self.session.get(self.endpoints['login'], auth=(self.username, self.password))
-        r.raise_for_status()
-
-        # Get homepage
-        r = self.session.get(self.endpoints['homepage'])
-        r.raise_for_status()
-
-        # Extract tables
-        soup = BeautifulSoup(r.content, SOUP_PARSER)
-        main_div = soup.find_all('div', {'class': 'row neuin py-2'})[2]
-        theory_entries = main_div.find_all('table')[0].find('tbody').find_all('tr')
-        laboratory_entries = main_div.find_all('table')[1].find('tbody').find_all('tr')
+        # Course index of the last run
+        self.manifest_file = manifest_file
+        self.manifest = read_manifest(manifest_file) if manifest_file else None
+        if self.manifest and self.manifest.get('url') != self.endpoints['homepage']:
+            self.manifest = None
 
-        self.data = {}
-
-        theory = []
-        for entry in theory_entries:
-            td = entry.find_all('td')
+        # Test credentials, a cached manifest means they already worked once
+        if self.manifest is None:
+            r = self.session.get(self.endpoints['login'], auth=(self.username, self.password))
+            r.raise_for_status()
 
-            links = []
-            for a in td[3].find_all('a'):
-                links.append({
-                    'title': a.text.strip(),
-                    'slug': slugify(a.text.strip()),
-                    'url': a.get('href'),
-                })
+        self.refresh()
+
+    @classmethod
+    def from_manifest(cls, manifest_file=MANIFEST_FILE):
+        # Read the course index without touching the network
+        manifest = read_manifest(manifest_file)
+        if manifest is None:
+            raise FileNotFoundError('No manifest in "{}".'.format(manifest_file))
+
+        scraper = cls.__new__(cls)
+        scraper.session = None
+        scraper.manifest_file = manifest_file
+        scraper.manifest = manifest
+        scraper.data = manifest['data']
+        return scraper
+
+    def refresh(self):
+        # Ask only for a changed homepage
+        headers_ = {}
+        if self.manifest and self.manifest.get('etag'):
+            headers_['If-None-Match'] = self.manifest['etag']
+        if self.manifest and self.manifest.get('last_modified'):
+            headers_['If-Modified-Since'] = self.manifest['last_modified']
+
+        r = self.session.get(self.endpoints['homepage'], headers=headers_)
+        if r.status_code == 304 and self.manifest:
+            self.data = self.manifest['data']
+            return False
 
-            theory.append({
-                'date': td[0].text.strip(),
-                'title': td[1].text.strip(),
-                'slug': slugify(td[1].text.strip()),
-                'links': links
-            })
-        self.data['theory'] = theory
-            
-        laboratory = []
-        for entry in laboratory_entries:
-            td = entry.find_all('td')
+        r.raise_for_status()
 
-            links = []
-            for a in td[3].find_all('a'):
-                links.append({
-                    'title': a.text.strip(),
-                    'slug': slugify(a.text.strip()),
-                    'url': a.get('href'),
-                })
+        # Extract tables
+        self.data = parse(r.content, extract_lessons)
+        self.manifest = {
+            'url': self.endpoints['homepage'],
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'updated': time.time(),
+            'data': self.data
+        }
+
+        if self.manifest_file:
+            write_manifest(self.manifest_file, self.manifest)
 
-            laboratory.append({
-                'date': td[0].text.strip(),
-                'title': td[1].text.strip(),
-                'slug': slugify(td[1].text.strip()),
-                'links': links
-            })
-        self.data['laboratory'] = laboratory
+        return True
 
     def get_all_links(self):
         for entry in self.data.get('theory'):
@@ -146,14 +152,40 @@ class BellettiniScraper():
                 yield link
 
 
+class NotModified(Exception):
+    pass
+
+
 class Downloader():
-    def __init__(self, download_folder=None):
+    # Smallest byte range worth its own connection
+    min_segment_size = 1024 * 1024
+
+    # Bounds of the adaptive chunk size
+    min_chunk_size = 64 * 1024
+    max_chunk_size = 4 * 1024 * 1024
+
+    # Errors worth another attempt
+    retryable_errors = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, http.client.HTTPException, ConnectionError, TimeoutError, EOFError)
+
+    # Seconds between two progress lines
+    progress_interval = 0.5
+
+    def __init__(self, download_folder=None, chunk_size=None, progress=False):
         if download_folder:
             self.download_folder = download_folder
             pathlib.Path(self.download_folder).mkdir(parents=True, exist_ok=True)
         else:
             self.download_folder = ''
 
+        # None picks a chunk size from Content-Length
+        self.chunk_size = chunk_size
+
+        # Metrics of every transfer, shared by all threads
+        self.progress = progress
+        self.transfers = []
+        self.lock = threading.Lock()
+        self.last_report = 0
+
     # https://stackoverflow.com/questions/1094841/
     @staticmethod
     def sizeof_fmt(num, suffix='B'):
@@ -163,55 +195,646 @@ class Downloader():
             num /= 1024.0
         return '%.1f%s%s' % (num, 'Yi', suffix)
 
-    def download(self, url, session=None, name=None):
+    def download(self, url, session=None, name=None, retries=3, segments=1, validators=None):
         # Extract name from url
         if name is None:
             name = url.split('/')[-1]
-            
+
         output_file = os.path.join(self.download_folder, name)
+        part_file = output_file + '.part'
+
+        # A killed segmented download leaves holes, it cannot be resumed
+        if os.path.exists(output_file + '.alloc'):
+            os.remove(output_file + '.alloc')
+
+        # Only a file on disk can be revalidated
+        if not os.path.exists(output_file):
+            validators = None
 
         # Prepare session
         if session:
             session_ = session
         else:
             session_ = requests.session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=segments)
+            session_.mount('http://', adapter)
+            session_.mount('https://', adapter)
+
+        transfer = {
+            'url': url,
+            'file': output_file,
+            'status': 'active',
+            'size': None,
+            'bytes': 0,
+            'ttfb': None,
+            'start': time.time(),
+            'duration': None,
+            'speed': None,
+            'retries': 0,
+            'etag': None,
+            'last_modified': None,
+            'error': None
+        }
+        with self.lock:
+            self.transfers.append(transfer)
+
+        start_time = time.perf_counter()
+        try:
+            # Split in byte ranges when the server allows it, unless there is a download to resume
+            if segments <= 1 or os.path.exists(part_file) or not self.download_segments(url, session_, output_file, segments, retries, transfer, validators):
+                for attempt in range(retries + 1):
+                    try:
+                        self.download_part(url, session_, output_file, transfer, validators)
+                        break
+                    except self.retryable_errors:
+                        if attempt == retries:
+                            raise
+                        self.count(transfer, retries=1)
+
+            # Only complete files get their final name
+            os.replace(part_file, output_file)
+            transfer['status'] = 'done'
+        except NotModified:
+            # The file on disk is still current
+            transfer['status'] = 'unchanged'
+        except BaseException as e:
+            transfer['status'] = 'failed'
+            transfer['error'] = str(e) or type(e).__name__
+            raise
+        finally:
+            transfer['duration'] = time.perf_counter() - start_time
+            if transfer['duration']:
+                transfer['speed'] = transfer['bytes'] / transfer['duration']
+            self.report()
+
+        return transfer
+
+    def count(self, transfer, size=0, retries=0):
+        with self.lock:
+            transfer['bytes'] += size
+            transfer['retries'] += retries
+        self.report()
+
+    @staticmethod
+    def record_response(transfer, r):
+        # Time from sending the request to parsing the response headers
+        if transfer['ttfb'] is None:
+            transfer['ttfb'] = r.elapsed.total_seconds()
+            transfer['etag'] = r.headers.get('ETag')
+            transfer['last_modified'] = r.headers.get('Last-Modified')
+
+    @staticmethod
+    def conditional_headers(validators):
+        headers_ = {}
+        if validators and validators.get('etag'):
+            headers_['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers_['If-Modified-Since'] = validators['last_modified']
+        return headers_
+
+    def report(self, force=False):
+        if not self.progress:
+            return
+
+        with self.lock:
+            now = time.perf_counter()
+            if not force and now - self.last_report < self.progress_interval:
+                return
+            self.last_report = now
+
+            active = [x for x in self.transfers if x['status'] == 'active']
+            done = sum(1 for x in self.transfers if x['status'] in ('done', 'unchanged'))
+            failed = sum(1 for x in self.transfers if x['status'] == 'failed')
+            received = sum(x['bytes'] for x in self.transfers)
+            elapsed = time.time() - min((x['start'] for x in self.transfers), default=time.time())
+
+            # Remaining bytes are only known for transfers with a Content-Length
+            remaining = ''
+            if active and all(x['size'] for x in active):
+                remaining = ', {} left'.format(self.sizeof_fmt(sum(x['size'] - x['bytes'] for x in active)))
+
+            print('\r\x1b[K{} done, {} failed, {} active: {} at {}/s{}'.format(
+                done, failed, len(active), self.sizeof_fmt(received), self.sizeof_fmt(received / elapsed if elapsed else 0), remaining
+            ), end='', file=sys.stderr, flush=True)
+
+    def summary(self):
+        with self.lock:
+            transfers = [dict(x) for x in self.transfers]
+
+        received = sum(x['bytes'] for x in transfers)
+        duration = 0
+        if transfers:
+            duration = max(x['start'] + (x['duration'] or 0) for x in transfers) - min(x['start'] for x in transfers)
+
+        return {
+            'files': len(transfers),
+            'failed': sum(1 for x in transfers if x['status'] == 'failed'),
+            'bytes': received,
+            'duration': duration,
+            'speed': received / duration if duration else None,
+            'retries': sum(x['retries'] for x in transfers),
+            'transfers': transfers
+        }
+
+    def write_summary(self, path):
+        summary = self.summary()
+
+        # Prometheus textfile for node_exporter, JSON otherwise
+        if path.endswith('.prom'):
+            def escape(value):
+                return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+            metrics = [
+                ('bytes_total', 'counter', 'Bytes received.', 'bytes'),
+                ('size_bytes', 'gauge', 'Expected size of the file.', 'size'),
+                ('ttfb_seconds', 'gauge', 'Time to the first response headers.', 'ttfb'),
+                ('duration_seconds', 'gauge', 'Time spent on the transfer.', 'duration'),
+                ('speed_bytes_per_second', 'gauge', 'Average throughput of the transfer.', 'speed'),
+                ('retries_total', 'counter', 'Attempts after the first one.', 'retries'),
+            ]
+
+            # Duplicate series make node_exporter reject the file, the last transfer of a file wins
+            latest = {}
+            for transfer in summary['transfers']:
+                latest[(transfer['url'], transfer['file'])] = transfer
+
+            lines = []
+            for name, kind, description, key in metrics:
+                lines.append('# HELP download_{} {}'.format(name, description))
+                lines.append('# TYPE download_{} {}'.format(name, kind))
+                for transfer in latest.values():
+                    if transfer[key] is not None:
+                        lines.append('download_{}{{url="{}",file="{}",status="{}"}} {}'.format(name, escape(transfer['url']), escape(transfer['file']), transfer['status'], transfer[key]))
+
+            lines.append('# HELP download_failed_files Files that could not be downloaded.')
+            lines.append('# TYPE download_failed_files gauge')
+            lines.append('download_failed_files {}'.format(summary['failed']))
+            lines.append('# HELP download_last_run_timestamp_seconds End of the last run.')
+            lines.append('# TYPE download_last_run_timestamp_seconds gauge')
+            lines.append('download_last_run_timestamp_seconds {}'.format(time.time()))
+            content = '\n'.join(lines) + '\n'
+        else:
+            content = json.dumps(summary, indent=2)
+
+        # Replace atomically, collectors may read it at any time
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+
+        return summary
+
+    def get_chunk_size(self, file_size=None):
+        if self.chunk_size:
+            return self.chunk_size
+
+        # About 64 reads per file
+        return min(max((file_size or 0) // 64, self.min_chunk_size), self.max_chunk_size)
+
+    @staticmethod
+    def copy_stream(r, f, chunk_size, limit=None):
+        # Compressed bodies need urllib3 to decode them
+        if r.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if limit is not None:
+                    chunk = chunk[:limit]
+                    limit -= len(chunk)
+
+                f.write(chunk)
+                yield len(chunk)
+
+                if limit == 0:
+                    return
+            return
+
+        # Read straight into one reused buffer, urllib3 would allocate a new bytes object per read
+        fp = getattr(r.raw, '_fp', None) or r.raw
+        buffer = memoryview(bytearray(chunk_size))
+
+        while limit is None or limit > 0:
+            size = fp.readinto(buffer if limit is None or limit >= chunk_size else buffer[:limit])
+            if not size:
+                break
+
+            f.write(buffer[:size])
+            if limit is not None:
+                limit -= size
+
+            yield size
+
+        # requests never saw the body, hand the connection back to the pool or closing the response drops it
+        if fp is not r.raw and fp.isclosed():
+            r._content_consumed = True
+            r.raw.release_conn()
+
+    def download_segments(self, url, session, output_file, segments, retries=3, transfer=None, validators=None):
+        # Probe size and range support
+        with session.get(url, stream=True, headers=dict(self.conditional_headers(validators), Range='bytes=0-0')) as r:
+            if transfer:
+                self.record_response(transfer, r)
+
+            if r.status_code == 304:
+                raise NotModified(url)
 
-        with session_.get(url, stream=True) as r:
             r.raise_for_status()
 
-            # Check if Transfer-Encoding is chunked
-            if r.headers.get('Transfer-Encoding') and r.headers.get('Transfer-Encoding').lower() == 'chunked':
-                chunk_size = None
-            else:
-                chunk_size = 4096
+            content_range = re.match(r'bytes 0-0/([0-9]+)$', r.headers.get('Content-Range', ''))
+            if r.status_code != 206 or not content_range:
+                return False
 
-            # Estimate time
+        file_size = int(content_range.group(1))
+        segments = min(segments, file_size // self.min_segment_size)
+        if segments < 2:
+            return False
+
+        if transfer:
+            transfer['size'] = file_size
+
+        # Segments are written at their offsets, the file becomes the .part file only once complete
+        alloc_file = output_file + '.alloc'
+        with open(alloc_file, 'wb') as f:
+            f.truncate(file_size)
+
+        segment_size = file_size // segments
+        bounds = [(i * segment_size, (i + 1) * segment_size - 1) for i in range(segments)]
+        bounds[-1] = (bounds[-1][0], file_size - 1)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(self.download_segment, url, session, alloc_file, start, end, retries, transfer) for start, end in bounds]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            # Holes in it cannot be told apart from data, so it cannot be resumed
+            os.remove(alloc_file)
+            raise
+
+        os.replace(alloc_file, output_file + '.part')
+
+        return True
+
+    def download_segment(self, url, session, alloc_file, start, end, retries=3, transfer=None):
+        position = start
+
+        for attempt in range(retries + 1):
+            try:
+                with session.get(url, stream=True, headers={'Range': 'bytes={}-{}'.format(position, end)}) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise EOFError('Server ignored the range of "{}".'.format(url))
+
+                    # Write at its offset, never past the segment
+                    with open(alloc_file, 'r+b') as f:
+                        f.seek(position)
+                        for size in self.copy_stream(r, f, self.get_chunk_size(end + 1 - start), limit=end + 1 - position):
+                            position += size
+                            if transfer:
+                                self.count(transfer, size)
+
+                if position != end + 1:
+                    raise EOFError('Incomplete segment of "{}": {} of {} bytes.'.format(url, position - start, end + 1 - start))
+
+                return
+            except self.retryable_errors:
+                if attempt == retries:
+                    raise
+                if transfer:
+                    self.count(transfer, retries=1)
+
+    def download_part(self, url, session, output_file, transfer=None, validators=None):
+        part_file = output_file + '.part'
+
+        # Resume a previous attempt, or ask only for a changed file
+        downloaded = 0
+        headers_ = {}
+        if os.path.exists(part_file):
+            downloaded = os.path.getsize(part_file)
+        if downloaded:
+            headers_['Range'] = 'bytes={}-'.format(downloaded)
+        else:
+            headers_.update(self.conditional_headers(validators))
+
+        with session.get(url, stream=True, headers=headers_) as r:
+            if transfer:
+                self.record_response(transfer, r)
+
+            if r.status_code == 304 and not downloaded:
+                raise NotModified(url)
+
+            if r.status_code == 416:
+                # Already complete
+                if r.headers.get('Content-Range') == 'bytes */{}'.format(downloaded):
+                    return
+
+                os.remove(part_file)
+                raise EOFError('Cannot resume "{}", restarting.'.format(part_file))
+
+            r.raise_for_status()
+
+            # Range not supported, start from scratch
+            if r.status_code != 206:
+                downloaded = 0
+
+            accept_ranges = r.status_code == 206 or r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+            # The size of compressed bodies is unknown
             file_size = r.headers.get('Content-Length')
-            if file_size:
-                file_size = int(file_size)
+            if file_size and r.headers.get('Content-Encoding', 'identity').lower() == 'identity':
+                file_size = downloaded + int(file_size)
+            else:
+                file_size = None
 
-            downloaded = 0
-            start_time = time.perf_counter()
+            if transfer:
+                transfer['size'] = file_size
 
-            # Save file
-            with open(output_file, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    f.write(chunk)
+            # Save file, its size is always the bytes received so far
+            with open(part_file, 'ab' if downloaded else 'wb') as f:
+                try:
+                    for size in self.copy_stream(r, f, self.get_chunk_size(file_size)):
+                        downloaded += size
+                        if transfer:
+                            self.count(transfer, size)
+                except BaseException:
+                    # Nothing to resume from
+                    if not accept_ranges:
+                        f.truncate(0)
+                    raise
+
+        # Check size before renaming
+        if file_size and os.path.getsize(part_file) != file_size:
+            raise EOFError('Incomplete download of "{}": {} of {} bytes.'.format(url, os.path.getsize(part_file), file_size))
+
+    def download_many(self, urls, session=None, workers=4, name=None, segments=1, validators=None):
+        # Prepare session
+        if session:
+            session_ = session
+        else:
+            session_ = requests.session()
 
-            #         if file_size:
-            #             downloaded += len(chunk)
+        # One pooled connection per worker and segment
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers * segments)
+        session_.mount('http://', adapter)
+        session_.mount('https://', adapter)
+
+        results = []
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for url in dict.fromkeys(urls):
+                # Links to the same file share one transfer, two workers would race on its .part
+                output_file = os.path.join(self.download_folder, name(url) if name else url.split('/')[-1])
+                if output_file not in futures:
+                    futures[output_file] = executor.submit(self.download, url, session_, name(url) if name else None, segments=segments, validators=validators(url) if validators else None)
+
+                results.append({
+                    'url': url,
+                    'future': futures[output_file]
+                })
 
-            #             downloaded_formatted = self.sizeof_fmt(downloaded)
-            #             file_size_formatted = self.sizeof_fmt(file_size)
-            #             mbps = downloaded // (time.perf_counter() - start_time) / 100000
-            #             percentage = downloaded / file_size * 100
+        # Collect errors per file
+        for result in results:
+            try:
+                result['transfer'] = result['future'].result()
+                result['error'] = None
+            except Exception as e:
+                result['transfer'] = None
+                result['error'] = e
+            del result['future']
 
-            #             print('\r\x1b[K{} of {} [{:3.1f}%] at {:3.1f} Mbps'.format(downloaded_formatted, file_size_formatted, percentage, mbps), end='', flush=True)
+        # End the progress line
+        if self.progress:
+            self.report(force=True)
+            print(file=sys.stderr)
 
-            # print('\r\x1b[KDone!')
+        return results
 
 
-        return True
+def read_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if not isinstance(manifest, dict) or 'data' not in manifest:
+        return None
+
+    return manifest
+
+
+def write_manifest(path, manifest):
+    # Replace atomically, a crash must not leave half a manifest
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def parse(content, extract, *args, parsers=None):
+    # Imported on first use, bs4 loads every tree builder it can find
+    from bs4 import BeautifulSoup, FeatureNotFound
+
+    # Fast parsers first, html5lib repairs malformed pages the way browsers do
+    error = None
+    for parser in parsers or SOUP_PARSERS:
+        try:
+            soup = BeautifulSoup(content, parser)
+        except FeatureNotFound as e:
+            error = e
+            continue
+
+        try:
+            return extract(soup, *args)
+        except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+            error = e
+
+    raise error
+
+
+def extract_lessons(soup):
+    main_div = soup.find_all('div', {'class': 'row neuin py-2'})[2]
+    tables = main_div.find_all('table')
+
+    data = {}
+    for key, table in (('theory', tables[0]), ('laboratory', tables[1])):
+        lessons = []
+        for entry in table.find('tbody').find_all('tr'):
+            td = entry.find_all('td')
+
+            links = []
+            for a in td[3].find_all('a'):
+                links.append({
+                    'title': a.text.strip(),
+                    'slug': slugify(a.text.strip()),
+                    'url': a.get('href'),
+                })
+
+            lessons.append({
+                'date': td[0].text.strip(),
+                'title': td[1].text.strip(),
+                'slug': slugify(td[1].text.strip()),
+                'links': links
+            })
+        data[key] = lessons
+
+    return data
+
+
+def file_name(link):
+    return link.split('down.php?FILENAME=')[1]
+
+
+def read_sync(path=SYNC_FILE):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {'files': {}}
+
+
+def sync_files(downloader, session, links, sync_file=SYNC_FILE, workers=8, segments=1, prune=False):
+    state = read_sync(sync_file)
+    files = state['files']
+
+    def validators(url):
+        # Revalidate only files still as they were downloaded, anything else is fetched again
+        entry = files.get(url)
+        if entry and os.path.isfile(entry['path']) and os.path.getsize(entry['path']) == entry['size']:
+            return entry
+        return None
+
+    results = downloader.download_many(links, session, workers=workers, segments=segments, name=file_name, validators=validators)
+
+    for result in results:
+        transfer = result['transfer']
+        if transfer is None:
+            # Keep what we had, the next sync retries
+            result['change'] = 'failed'
+            continue
+
+        previous = files.get(result['url'], {})
+        if transfer['status'] == 'unchanged':
+            result['change'] = 'unchanged'
+        else:
+            result['change'] = 'changed' if previous else 'new'
+
+        files[result['url']] = {
+            'path': transfer['file'],
+            'size': os.path.getsize(transfer['file']),
+            'etag': transfer['etag'] or (previous.get('etag') if transfer['status'] == 'unchanged' else None),
+            'last_modified': transfer['last_modified'] or (previous.get('last_modified') if transfer['status'] == 'unchanged' else None)
+        }
+
+    # Local files no course page links to anymore
+    linked = {os.path.abspath(os.path.join(downloader.download_folder, file_name(link))) for link in links}
+    unlinked = []
+    for root, _, names in os.walk(downloader.download_folder or '.'):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.abspath(path) not in linked and not name.endswith(('.part', '.alloc')):
+                unlinked.append(path)
+
+    for url in [x for x in files if x not in links]:
+        if prune or not os.path.isfile(files[url]['path']):
+            del files[url]
+
+    if prune:
+        for path in unlinked:
+            os.remove(path)
+
+    write_manifest(sync_file, state)
+
+    return results, unlinked
+
+
+def video_archive_id(url):
+    from youtube_dl.extractor import gen_extractor_classes
+
+    # Same key youtube_dl writes to the archive, found without network calls
+    for ie in gen_extractor_classes():
+        if ie.ie_key() != 'Generic' and ie.suitable(url):
+            try:
+                return '{} {}'.format(ie.ie_key().lower(), ie._match_id(url))
+            except (AssertionError, AttributeError, IndexError):
+                return None
+
+    return None
+
+
+# One YoutubeDL per worker process
+ydl = None
+
+
+def init_video_worker(options):
+    import youtube_dl
+
+    global ydl
+    ydl = youtube_dl.YoutubeDL(options)
+
+
+def download_video(url):
+    # Errors go back as strings, not every youtube_dl exception pickles
+    try:
+        ydl.download([url])
+    except Exception as e:
+        return str(e) or type(e).__name__
+
+    return None
+
+
+def download_videos(links, workers=2, archive=VIDEO_ARCHIVE, failures_file=VIDEO_FAILURES, retries=2):
+    try:
+        with open(archive, 'r') as f:
+            archived = set(line.strip() for line in f)
+    except FileNotFoundError:
+        archived = set()
+
+    try:
+        with open(failures_file, 'r') as f:
+            failures = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        failures = {}
+
+    # youtube_dl only checks its archive after extracting the video, skip known ones before that
+    links = list(dict.fromkeys(links))
+    pending = [x for x in links if video_archive_id(x) not in archived]
+    skipped = len(links) - len(pending)
+
+    options = {
+        'format': 'best',
+        'retries': 5,
+        'download_archive': archive,
+        'quiet': True,
+        'noprogress': True
+    }
+
+    downloaded = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_video_worker, initargs=(options,)) as executor:
+        for attempt in range(retries + 1):
+            if len(pending) == 0:
+                break
+
+            # Back off before retrying failures
+            if attempt:
+                time.sleep(2 ** attempt)
+
+            futures = {executor.submit(download_video, url): url for url in pending}
+            pending = []
+            for future in concurrent.futures.as_completed(futures):
+                url = futures[future]
+                error = future.result()
+                if error:
+                    pending.append(url)
+                    failures[url] = {
+                        'error': error,
+                        'attempts': failures.get(url, {}).get('attempts', 0) + 1,
+                        'last_attempt': time.time()
+                    }
+                else:
+                    downloaded.append(url)
+                    failures.pop(url, None)
+
+    # Failures are kept, the next run retries them
+    write_manifest(failures_file, failures)
+
+    return downloaded, skipped, {x: failures[x] for x in pending}
 
 
 def slugify(string):
@@ -221,8 +844,8 @@ def slugify(string):
 
 
 def main(args):
-    downloader = Downloader('files')
-    scraper = BellettiniScraper(args.username, args.password)
+    downloader = Downloader('files', progress=sys.stderr.isatty())
+    scraper = BellettiniScraper(args.username, args.password, None if args.no_cache else args.manifest)
 
     # Download all files if user didn't specify anything
     if args.videos == False and args.files == False:
@@ -231,18 +854,48 @@ def main(args):
 
     # Download files
     if args.files:
-        for link in scraper.get_files_links():
-            print(link)
-            downloader.download(link, scraper.session, name=link.split('down.php?FILENAME=')[1])
+        links = list(scraper.get_files_links())
+        if args.sync:
+            results, unlinked = sync_files(downloader, scraper.session, links, args.sync_file, args.workers, args.segments, args.prune)
+        else:
+            results = downloader.download_many(links, scraper.session, workers=args.workers, segments=args.segments, name=file_name)
+
+        for result in results:
+            if result['error']:
+                print('Failed: {} ({})'.format(result['url'], result['error']))
+            elif result.get('change') == 'unchanged':
+                continue
+            else:
+                transfer = result['transfer']
+                print('{} ({} in {:.1f}s at {}/s, TTFB {:.0f}ms, {} retries)'.format(
+                    result['url'], downloader.sizeof_fmt(transfer['bytes']), transfer['duration'], downloader.sizeof_fmt(transfer['speed'] or 0),
+                    (transfer['ttfb'] or 0) * 1000, transfer['retries']
+                ))
+
+        if args.sync:
+            for path in unlinked:
+                print('{}: {} (no longer linked)'.format('Pruned' if args.prune else 'Unlinked', path))
+
+            changes = [x['change'] for x in results]
+            print('Sync: {} new, {} changed, {} unchanged, {} failed, {} unlinked.'.format(
+                changes.count('new'), changes.count('changed'), changes.count('unchanged'), changes.count('failed'), len(unlinked)
+            ))
+
+        if args.metrics:
+            summary = downloader.write_summary(args.metrics)
+            print('Downloaded {} of {} files, {} in {:.1f}s, summary written to "{}".'.format(
+                summary['files'] - summary['failed'], summary['files'], downloader.sizeof_fmt(summary['bytes']), summary['duration'], args.metrics
+            ))
 
     # Download videos
     if args.videos:
-        with youtube_dl.YoutubeDL({'format': 'best', 'retries': 5}) as ydl:
-            for link in scraper.get_youtube_links():
-                try:
-                    ydl.download([link])
-                except:
-                    pass
+        downloaded, skipped, failures = download_videos(scraper.get_youtube_links(), args.video_workers, args.archive)
+        for url in downloaded:
+            print(url)
+        for url, failure in failures.items():
+            print('Failed: {} ({}, {} attempts)'.format(url, failure['error'], failure['attempts']))
+
+        print('Videos: {} downloaded, {} already in "{}", {} failed.'.format(len(downloaded), skipped, args.archive, len(failures)))
 
 
 if __name__ == '__main__':
@@ -251,4 +904,14 @@ if __name__ == '__main__':
     parser.add_argument('password', help='your @studenti.unimi.it password')
     parser.add_argument('--videos', help='download YouTube videos', action='store_true')
     parser.add_argument('--files', help='download files', action='store_true')
+    parser.add_argument('-w', '--workers', help='parallel file downloads', type=int, default=8)
+    parser.add_argument('--video-workers', help='parallel video downloads, one process each', type=int, default=2)
+    parser.add_argument('--archive', help='youtube_dl download archive, videos listed there are skipped', default=VIDEO_ARCHIVE)
+    parser.add_argument('-s', '--segments', help='connections per large file', type=int, default=1)
+    parser.add_argument('--sync', help='download only new or changed files', action='store_true')
+    parser.add_argument('--sync-file', help='where the state of synced files is kept', default=SYNC_FILE)
+    parser.add_argument('--prune', help='with --sync, delete local files that are no longer linked', action='store_true')
+    parser.add_argument('--manifest', help='where the parsed course index is cached', default=MANIFEST_FILE)
+    parser.add_argument('--no-cache', help='always download and parse the homepage', action='store_true')
+    parser.add_argument('-m', '--metrics', help='write transfer metrics to a JSON file, or a Prometheus textfile if it ends in .prom')
     main(parser.parse_args())
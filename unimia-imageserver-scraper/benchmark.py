@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Giacomo Ferretti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from urllib.parse import unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from imageserver_scraper import BASE_URL, CHUNK_SIZE, canonicalize, extract_entries, find_all_links, iter_links
+
+FILES_TXT = 'files.txt'
+
+
+def count_lines(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def autoindex_page(path, names, parent_link):
+    # Same markup as Apache's mod_autoindex with column sorting suppressed
+    rows = [f'<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="{parent_link}">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td><td>&nbsp;</td></tr>']
+    for name in names:
+        icon, alt = ('folder.gif', '[DIR]') if name[-1] == '/' else ('unknown.gif', '[   ]')
+        rows.append(f'<tr><td valign="top"><img src="/icons/{icon}" alt="{alt}"></td><td><a href="{name}">{name}</a></td><td align="right">2020-05-01 12:00  </td><td align="right">  - </td><td>&nbsp;</td></tr>')
+
+    return (
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n'
+        f'<html>\n <head>\n  <title>Index of {path}</title>\n </head>\n <body>\n<h1>Index of {path}</h1>\n'
+        '  <table>\n   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th>Name</th><th>Last modified</th><th>Size</th><th>Description</th></tr>\n'
+        '   <tr><th colspan="5"><hr></th></tr>\n'
+        + '\n'.join(rows) +
+        '\n   <tr><th colspan="5"><hr></th></tr>\n</table>\n</body></html>\n'
+    )
+
+
+def synthetic_tree(size, fanout=8, files_per_dir=32):
+    # Generate autoindex listings breadth first until `size` entries exist
+    base_url = BASE_URL + '/'
+
+    pages = {}
+    queue = [(base_url, '/')]
+    total = 0
+
+    while len(queue) != 0:
+        url, parent_link = queue.pop(0)
+        links = [parent_link]
+
+        for i in range(fanout):
+            if total >= size:
+                break
+            links.append(f'dir{i}/')
+            queue.append((url + f'dir{i}/', urlsplit(url).path))
+            total += 1
+
+        for i in range(files_per_dir):
+            if total >= size:
+                break
+            links.append(f'file%20{i}.gif')
+            total += 1
+
+        pages[canonicalize(url)] = (url, links)
+
+    return base_url, pages
+
+
+def walk(base_url, pages):
+    # Depth first traversal of the listings, as the serial crawler does
+    dump = []
+    targets = [base_url]
+    seen = {canonicalize(base_url)}
+
+    while len(targets) != 0:
+        url, links = pages[canonicalize(targets.pop())]
+        seen.add(canonicalize(url))
+
+        for entry in extract_entries(url, links, seen):
+            dump.append(entry)
+
+            if entry['type'] == 'directory':
+                targets.append(entry['link'])
+
+    return dump
+
+
+def tree_from_files(path):
+    # Directory path -> names listed in its index page
+    tree = {}
+    with open(path) as f:
+        for line in f:
+            parts = urlsplit(line.strip()).path.split('/')
+            is_directory = parts[-1] == ''
+            if is_directory:
+                parts = parts[:-1]
+
+            for i in range(1, len(parts)):
+                directory = '/'.join(parts[:i]) + '/'
+                name = parts[i] + ('/' if i < len(parts) - 1 or is_directory else '')
+                names = tree.setdefault(directory, {})
+                names[name] = None
+
+            if is_directory:
+                tree.setdefault('/'.join(parts) + '/', {})
+
+    return {directory: list(names) for directory, names in tree.items()}
+
+
+def generate_tree(depth, fanout, files_per_dir):
+    base_path = urlsplit(BASE_URL).path + '/'
+    tree = {}
+
+    targets = [(base_path, 0)]
+    while len(targets) != 0:
+        directory, level = targets.pop()
+        names = [f'file{i}.gif' for i in range(files_per_dir)]
+
+        if level < depth:
+            for i in range(fanout):
+                names.append(f'dir{i}/')
+                targets.append((directory + f'dir{i}/', level + 1))
+
+        tree[directory] = names
+
+    return tree
+
+
+class AutoindexServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tree, latency=0.0, error_rate=0.0):
+        super().__init__(('127.0.0.1', 0), AutoindexHandler)
+        self.tree = tree
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pages = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}' + urlsplit(BASE_URL).path + '/'
+
+
+class AutoindexHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body go out in separate writes, Nagle would hold the body for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        path = unquote(urlsplit(self.path).path)
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            return self.reply(503, b'Service Unavailable')
+
+        if path not in server.tree:
+            return self.reply(404, b'Not Found')
+
+        with server.lock:
+            server.pages += 1
+
+        parent_link = path.rsplit('/', 2)[0] + '/'
+        self.reply(200, autoindex_page(path, server.tree[path], parent_link).encode())
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html;charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def legacy_walk(base_url, pages):
+    # The original crawler loop, with a list as visited set
+    dump = []
+    targets = [base_url]
+    already_scanned = []
+
+    while len(targets) != 0:
+        url, links = pages[canonicalize(targets.pop())]
+
+        for link in links:
+            if link == '/' or ('http://unimia.unimi.it' + link) in already_scanned:
+                continue
+
+            link_type = 'file'
+            if link[-1] == '/':
+                link_type = 'directory'
+
+            dump.append({'type': link_type, 'link': url + link})
+
+            if link_type != 'file':
+                targets.append(url + link)
+
+        already_scanned.append(url)
+
+    return dump
+
+
+def bench_visited(args):
+    size = args.size or count_lines(FILES_TXT)
+
+    print(f'{"entries":>8} {"links":>8} {"index ns/link":>15} {"legacy ns/link":>15}')
+    for fraction in (8, 4, 2, 1):
+        base_url, pages = synthetic_tree(size // fraction, args.fanout, args.files_per_dir)
+        links = sum(len(x[1]) for x in pages.values())
+
+        start_time = time.perf_counter()
+        dump = walk(base_url, pages)
+        elapsed = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        legacy_walk(base_url, pages)
+        legacy_elapsed = time.perf_counter() - start_time
+
+        print(f'{len(dump):>8} {links:>8} {elapsed / links * 1e9:>15.0f} {legacy_elapsed / links * 1e9:>15.0f}')
+
+
+def bench_extract(args):
+    names = [f'dir{i}/' if i % 10 == 0 else f'file%20{i}.gif' for i in range(args.entries)]
+    page = autoindex_page('/imageserver/big/', names, '/imageserver/').encode()
+    chunks = [page[i:i + CHUNK_SIZE] for i in range(0, len(page), CHUNK_SIZE)]
+
+    def regex():
+        # The whole page is downloaded and decoded before parsing
+        return find_all_links(b''.join(chunks).decode('utf-8'))
+
+    def streaming():
+        return list(iter_links(iter(chunks)))
+
+    if regex() != streaming():
+        print('ERROR: extractors disagree.')
+        exit(1)
+
+    print(f'Page: {len(page)} bytes, {len(names) + 1} links, {len(chunks)} chunks of {CHUNK_SIZE} bytes')
+    print(f'{"extractor":>10} {"ms/page":>10} {"peak memory":>12}')
+    for name, extractor in (('regex', regex), ('streaming', streaming)):
+        start_time = time.perf_counter()
+        for _ in range(args.repeat):
+            extractor()
+        elapsed = (time.perf_counter() - start_time) / args.repeat
+
+        tracemalloc.start()
+        extractor()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f'{name:>10} {elapsed * 1000:>10.2f} {peak / 1024:>10.0f}KiB')
+
+
+def bench_crawl(args):
+    if args.synthetic:
+        tree = generate_tree(args.depth, args.fanout, args.files_per_dir)
+    else:
+        tree = tree_from_files(args.files)
+
+    entries = sum(len(x) for x in tree.values())
+    print(f'Tree: {len(tree)} directories, {entries} entries, latency {args.latency * 1000:.0f}ms, error rate {args.error_rate:.1%}')
+
+    server = AutoindexServer(tree, args.latency, args.error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    scraper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imageserver_scraper.py')
+
+    print(f'{"workers":>8} {"wall time":>10} {"pages/s":>9} {"peak RSS":>10} {"errors":>7} {"records":>8}')
+    for workers in args.workers:
+        server.pages = server.errors = 0
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'dump.ndjson')
+            command = [
+                sys.executable, scraper, 'crawl', '--no-proxy',
+                '--base-url', server.base_url,
+                '--output', output,
+                '--state', os.path.join(tmp, 'state.db'),
+                '--workers', str(workers),
+                '--per-host', str(workers),
+                '--retries', str(args.retries)
+            ]
+
+            start_time = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+            _, status, rusage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start_time
+            process.returncode = os.waitstatus_to_exitcode(status)
+
+            if process.returncode != 0:
+                print(f'ERROR: crawler exited with {process.returncode}.')
+                exit(1)
+
+            with open(output) as f:
+                records = sum(1 for _ in f)
+
+        # ru_maxrss is in KiB on Linux
+        print(f'{workers:>8} {elapsed:>9.2f}s {server.pages / elapsed:>9.1f} {rusage.ru_maxrss / 1024:>8.1f}MiB {server.errors:>7} {records:>8}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    visited = subparsers.add_parser('visited', help='per-link cost of the visited index')
+    visited.add_argument('-n', '--size', help='entries in the synthetic tree (default: size of files.txt)', type=int)
+    visited.add_argument('--fanout', help='subdirectories per directory', type=int, default=8)
+    visited.add_argument('--files-per-dir', help='files per directory', type=int, default=32)
+    visited.set_defaults(func=bench_visited)
+
+    extract = subparsers.add_parser('extract', help='link extraction from a large index page')
+    extract.add_argument('-n', '--entries', help='entries in the index page', type=int, default=20000)
+    extract.add_argument('--repeat', help='runs to average', type=int, default=10)
+    extract.set_defaults(func=bench_extract)
+
+    crawl = subparsers.add_parser('crawl', help='crawl a local autoindex stand-in server')
+    crawl.add_argument('-f', '--files', help='list of urls to serve', default=FILES_TXT)
+    crawl.add_argument('-s', '--synthetic', help='serve a synthetic tree instead of --files', action='store_true')
+    crawl.add_argument('--depth', help='depth of the synthetic tree', type=int, default=3)
+    crawl.add_argument('--fanout', help='subdirectories per directory', type=int, default=6)
+    crawl.add_argument('--files-per-dir', help='files per directory', type=int, default=32)
+    crawl.add_argument('-l', '--latency', help='seconds added to every response', type=float, default=0.02)
+    crawl.add_argument('-e', '--error-rate', help='fraction of requests answered with 503', type=float, default=0.0)
+    crawl.add_argument('--retries', help='crawler retries for a failed directory', type=int, default=5)
+    crawl.add_argument('-w', '--workers', help='crawler worker counts to compare', type=int, nargs='+', default=[1, 4, 16])
+    crawl.set_defaults(func=bench_crawl)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+# Copyright 2020 Giacomo Ferretti
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import struct
+import argparse
+from fnmatch import fnmatchcase
+from urllib.parse import urlsplit
+
+from imageserver_scraper import iter_dump
+
+# Index layout:
+#   header | prefix | nodes | names
+# Nodes are stored breadth first, so the children of a node are contiguous
+# and sorted by name. The root node is the prefix (scheme and host).
+MAGIC = b'UIDX'
+VERSION = 2
+
+HEADER = struct.Struct('<4sHII')
+
+# parent, name offset, name length, is file, first child, children, files, directories
+# Dumps only record links, autoindex sizes are rounded, so there is no size
+NODE = struct.Struct('<IIHBIIII')
+
+TYPE_DIRECTORY = 0
+TYPE_FILE = 1
+
+
+def build_index(dump_file, index_file):
+    prefix = None
+    root = {'children': {}, 'type': TYPE_DIRECTORY}
+
+    # Build the tree in memory
+    for entry in iter_dump(dump_file):
+        url = urlsplit(entry['link'])
+        if prefix is None:
+            prefix = f'{url.scheme}://{url.netloc}'
+        elif prefix != f'{url.scheme}://{url.netloc}':
+            raise ValueError(f'Cannot index "{entry["link"]}", the dump is rooted at "{prefix}".')
+
+        node = root
+        for name in url.path.strip('/').split('/'):
+            node = node['children'].setdefault(name, {'children': {}, 'type': TYPE_DIRECTORY})
+
+        if entry['type'] == 'file':
+            node['type'] = TYPE_FILE
+
+    # Assign ids breadth first
+    order = [(root, 0, '')]
+    first_child = []
+    for node, _, _ in order:
+        first_child.append(len(order))
+        for name in sorted(node['children']):
+            order.append((node['children'][name], len(first_child) - 1, name))
+
+    # Sum subtrees bottom up
+    totals = [[0, 0] for _ in order]
+    for i in range(len(order) - 1, 0, -1):
+        node, parent, _ = order[i]
+        files, directories = totals[i]
+        if node['type'] == TYPE_FILE:
+            files += 1
+        else:
+            directories += 1
+
+        totals[parent][0] += files
+        totals[parent][1] += directories
+
+    names = bytearray()
+    nodes = bytearray()
+    for i, (node, parent, name) in enumerate(order):
+        name = name.encode()
+        nodes += NODE.pack(parent, len(names), len(name), node['type'], first_child[i], len(node['children']), *totals[i])
+        names += name
+
+    prefix = (prefix or '').encode()
+    with open(index_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(order), len(prefix)))
+        f.write(prefix)
+        f.write(nodes)
+        f.write(names)
+
+    return len(order)
+
+
+class DumpIndex():
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, prefix_length = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'"{path}" is not a dump index.')
+
+        self.prefix = self.mm[HEADER.size:HEADER.size + prefix_length].decode()
+        self.nodes_offset = HEADER.size + prefix_length
+        self.names_offset = self.nodes_offset + self.count * NODE.size
+
+    def node(self, i):
+        return NODE.unpack_from(self.mm, self.nodes_offset + i * NODE.size)
+
+    def name(self, i):
+        _, offset, length, *_ = self.node(i)
+        return self.mm[self.names_offset + offset:self.names_offset + offset + length].decode()
+
+    def is_file(self, i):
+        return self.node(i)[3] == TYPE_FILE
+
+    def children(self, i):
+        node = self.node(i)
+        return range(node[4], node[4] + node[5])
+
+    def child(self, i, name):
+        # Children are sorted, binary search them
+        children = self.children(i)
+        name = name.encode()
+        low, high = 0, len(children)
+        while low < high:
+            middle = (low + high) // 2
+            _, offset, length, *_ = self.node(children[middle])
+            current = self.mm[self.names_offset + offset:self.names_offset + offset + length]
+            if current == name:
+                return children[middle]
+            elif current < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def find(self, path):
+        i = 0
+        for name in path.strip('/').split('/'):
+            if name == '':
+                continue
+
+            i = self.child(i, name)
+            if i is None:
+                return None
+
+        return i
+
+    def url(self, i):
+        names = []
+        node = i
+        while node != 0:
+            names.append(self.name(node))
+            node = self.node(node)[0]
+
+        url = self.prefix + '/' + '/'.join(reversed(names))
+        if not self.is_file(i) and len(names) != 0:
+            url += '/'
+        return url
+
+    def walk(self, i=0):
+        # Pre-order, so urls come out sorted
+        stack = [i]
+        while len(stack) != 0:
+            current = stack.pop()
+            yield current
+            stack.extend(reversed(self.children(current)))
+
+    def glob(self, pattern):
+        # Match one path component at a time, pruning unmatched subtrees
+        parts = pattern.strip('/').split('/')
+        stack = [(0, 0)]
+        while len(stack) != 0:
+            i, depth = stack.pop()
+            if parts[depth] == '**':
+                # '**' matches any number of directories
+                if depth + 1 == len(parts):
+                    yield from (x for x in self.walk(i) if x != i)
+                    continue
+                stack.extend((child, depth) for child in reversed(self.children(i)) if not self.is_file(child))
+                stack.append((i, depth + 1))
+                continue
+
+            matches = [x for x in self.children(i) if fnmatchcase(self.name(x), parts[depth])]
+            if depth + 1 == len(parts):
+                yield from matches
+            else:
+                stack.extend((x, depth + 1) for x in reversed(matches) if not self.is_file(x))
+
+
+def diff(old, new, i=0, j=0):
+    # Merge the sorted children of both trees
+    old_children = [(old.name(x), x) for x in old.children(i)]
+    new_children = [(new.name(x), x) for x in new.children(j)]
+
+    a, b = 0, 0
+    while a < len(old_children) or b < len(new_children):
+        if b == len(new_children) or (a < len(old_children) and old_children[a][0] < new_children[b][0]):
+            yield from (('-', old.url(x)) for x in old.walk(old_children[a][1]))
+            a += 1
+        elif a == len(old_children) or new_children[b][0] < old_children[a][0]:
+            yield from (('+', new.url(x)) for x in new.walk(new_children[b][1]))
+            b += 1
+        else:
+            x, y = old_children[a][1], new_children[b][1]
+            if old.is_file(x) != new.is_file(y):
+                yield from (('-', old.url(z)) for z in old.walk(x))
+                yield from (('+', new.url(z)) for z in new.walk(y))
+            else:
+                yield from diff(old, new, x, y)
+            a += 1
+            b += 1
+
+
+def resolve(index, path):
+    i = index.find(path)
+    if i is None:
+        print(f'ERROR: "{path}" not found.')
+        exit(1)
+
+    return i
+
+
+def main_build(args):
+    count = build_index(args.dump, args.index)
+    print(f'Indexed {count} entries into "{args.index}".')
+
+
+def main_ls(args):
+    index = DumpIndex(args.index)
+    for i in index.children(resolve(index, args.path)):
+        print(index.name(i) + ('' if index.is_file(i) else '/'))
+
+
+def main_glob(args):
+    index = DumpIndex(args.index)
+    for i in index.glob(args.pattern):
+        print(index.url(i))
+
+
+def main_du(args):
+    index = DumpIndex(args.index)
+    i = resolve(index, args.path)
+
+    targets = [i] if index.is_file(i) else index.children(i)
+    for x in targets:
+        *_, files, directories = index.node(x)
+        print(f'{files:>8} {directories:>8}  {index.url(x)}')
+
+    *_, files, directories = index.node(i)
+    print(f'{files:>8} {directories:>8}  {index.url(i)} (total)')
+
+
+def main_diff(args):
+    old = DumpIndex(args.old)
+    new = DumpIndex(args.new)
+    for sign, url in diff(old, new):
+        print(sign, url)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='index a dump (JSON, NDJSON or list of urls)')
+    build_parser.add_argument('dump', help='dump file')
+    build_parser.add_argument('index', help='index file', nargs='?', default='server_dump.idx')
+    build_parser.set_defaults(func=main_build)
+
+    ls_parser = subparsers.add_parser('ls', help='list a directory')
+    ls_parser.add_argument('path', help='directory path, e.g. /imageserver/legacy/', nargs='?', default='/')
+    ls_parser.add_argument('-i', '--index', help='index file', default='server_dump.idx')
+    ls_parser.set_defaults(func=main_ls)
+
+    glob_parser = subparsers.add_parser('glob', help='find entries matching a pattern, e.g. /imageserver/**/*.gif')
+    glob_parser.add_argument('pattern', help='glob pattern')
+    glob_parser.add_argument('-i', '--index', help='index file', default='server_dump.idx')
+    glob_parser.set_defaults(func=main_glob)
+
+    du_parser = subparsers.add_parser('du', help='count files and directories of a subtree')
+    du_parser.add_argument('path', help='directory path', nargs='?', default='/')
+    du_parser.add_argument('-i', '--index', help='index file', default='server_dump.idx')
+    du_parser.set_defaults(func=main_du)
+
+    diff_parser = subparsers.add_parser('diff', help='show entries added and removed between two indexes')
+    diff_parser.add_argument('old', help='old index file')
+    diff_parser.add_argument('new', help='new index file')
+    diff_parser.set_defaults(func=main_diff)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -14,13 +14,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
 import json
+import time
+import sqlite3
+import queue
+import argparse
+import threading
+from fnmatch import fnmatchcase
+from urllib.parse import quote, unquote, urljoin, urlsplit, urlunsplit
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 import requests
 
 BASE_URL = 'http://unimia.unimi.it/imageserver'
 
 HREF_REGEX = re.compile(r'<a\s+(?:[^>]*?\s+)?href=(["\'])(.*?)\1')
+HREF_BYTES_REGEX = re.compile(HREF_REGEX.pattern.encode())
+
+CHUNK_SIZE = 16384
+
+CANONICAL_SAFE_CHARS = '/:@!$&\'()*+,;='
 
 headers = {
     'User-Agent': 'Mozilla/5.0'
@@ -38,51 +53,668 @@ def find_all_links(string):
     return [x[1] for x in HREF_REGEX.findall(string)]
 
 
-if __name__ == '__main__':
-    dump = []
-    targets = [BASE_URL]
-    already_scanned = []
+def iter_links(chunks, encoding='utf-8'):
+    buffer = b''
+
+    for chunk in chunks:
+        buffer += chunk
+
+        end = 0
+        for match in HREF_BYTES_REGEX.finditer(buffer):
+            yield match.group(2).decode(encoding, 'replace')
+            end = match.end()
+
+        # Keep only a tag that may continue in the next chunk
+        start = buffer.rfind(b'<', end)
+        buffer = buffer[start:] if start != -1 else b''
+
+
+# https://stackoverflow.com/questions/1094841/
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return '%3.1f%s%s' % (num, unit, suffix)
+        num /= 1024.0
+    return '%.1f%s%s' % (num, 'Yi', suffix)
+
+
+def canonicalize(url):
+    scheme, netloc, path, query, _ = urlsplit(url)
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+
+    # Drop default ports
+    if (scheme, netloc.rsplit(':', 1)[-1]) in (('http', '80'), ('https', '443')):
+        netloc = netloc.rsplit(':', 1)[0]
+
+    # Normalize percent-encoding and trailing slashes
+    path = quote(unquote(path), safe=CANONICAL_SAFE_CHARS).rstrip('/') or '/'
+
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def resolve(url, link):
+    # Plain relative names are by far the most common autoindex links
+    if url[-1:] == '/' and link[:1] not in ('', '/', '.', '?', '#') and ':' not in link:
+        return url + link
+
+    return urljoin(url, link)
+
+
+def extract_entries(url, links, seen):
+    entries = []
+
+    for link in links:
+        if link == '/':
+            continue
+
+        # Skip already scanned or recorded
+        target = resolve(url, link)
+        key = canonicalize(target)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        # Extract filetype
+        link_type = 'file'
+        if link[-1] == '/':
+            link_type = 'directory'
+
+        entries.append({'type': link_type, 'link': target})
+
+    return entries
+
+
+class CrawlState():
+    def __init__(self, path, resume=False):
+        self.db = sqlite3.connect(path)
+
+        # Start from scratch unless resuming
+        if not resume:
+            self.db.execute('DROP TABLE IF EXISTS frontier')
+
+        self.db.execute('''CREATE TABLE IF NOT EXISTS frontier (
+            url TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            final_url TEXT,
+            links TEXT,
+            etag TEXT,
+            last_modified TEXT
+        )''')
+
+        # Databases written before conditional requests
+        columns = [x[1] for x in self.db.execute('PRAGMA table_info(frontier)')]
+        for column in ('etag', 'last_modified'):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE frontier ADD COLUMN {column} TEXT')
+
+        self.db.commit()
+
+    def add(self, url):
+        # Stale directories from the previous crawl go back to the frontier
+        self.db.execute('INSERT INTO frontier (url) VALUES (?) ON CONFLICT (url) DO UPDATE SET status = \'pending\' WHERE status = \'stale\'', (url,))
+
+    def done(self, url, final_url, links, etag=None, last_modified=None):
+        self.db.execute('UPDATE frontier SET status = \'done\', final_url = ?, links = ?, etag = ?, last_modified = ? WHERE url = ?', (final_url, json.dumps(links), etag, last_modified, url))
+
+    def reuse(self, url):
+        # Keep the listing of the previous crawl
+        cursor = self.db.execute('UPDATE frontier SET status = \'done\' WHERE url = ? AND links IS NOT NULL', (url,))
+        return cursor.rowcount != 0
+
+    def listing(self, url):
+        row = self.db.execute('SELECT final_url, links FROM frontier WHERE url = ? AND links IS NOT NULL', (url,)).fetchone()
+        if row is None:
+            return None
+
+        return row[0], json.loads(row[1])
+
+    def validators(self):
+        validators = {}
+        for url, etag, last_modified in self.db.execute('SELECT url, etag, last_modified FROM frontier WHERE links IS NOT NULL AND (etag IS NOT NULL OR last_modified IS NOT NULL)'):
+            validators[url] = (etag, last_modified)
+        return validators
+
+    def begin_incremental(self, base_url):
+        # Every directory must be confirmed again, starting from the root
+        self.db.execute('UPDATE frontier SET status = \'stale\', attempts = 0')
+        self.add(base_url)
+        self.db.commit()
+
+    def prune(self):
+        # Directories not reached again are gone
+        cursor = self.db.execute('DELETE FROM frontier WHERE status = \'stale\'')
+        return cursor.rowcount
+
+    def fail(self, url):
+        self.db.execute('UPDATE frontier SET status = \'failed\', attempts = attempts + 1 WHERE url = ?', (url,))
+
+    def retry(self, max_attempts):
+        # Move failed urls back to the frontier
+        cursor = self.db.execute('UPDATE frontier SET status = \'pending\' WHERE status = \'failed\' AND attempts < ?', (max_attempts,))
+        return cursor.rowcount
+
+    def reset_attempts(self):
+        self.db.execute('UPDATE frontier SET attempts = 0 WHERE status = \'failed\'')
+
+    def urls(self, status=None):
+        if status:
+            return [x[0] for x in self.db.execute('SELECT url FROM frontier WHERE status = ?', (status,))]
+        return [x[0] for x in self.db.execute('SELECT url FROM frontier')]
+
+    def checkpoint(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class DumpWriter():
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.seen = set()
+
+        if resume and os.path.exists(path):
+            self.recover()
+            self.f = open(path, 'a')
+        else:
+            self.f = open(path, 'w')
+
+    def recover(self):
+        # Drop a record truncated by a crash
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+        # Records written after the last checkpoint will be found again
+        with open(self.path) as f:
+            for line in f:
+                self.seen.add(canonicalize(json.loads(line)['link']))
+
+    def write(self, entry):
+        self.f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def fetch_index(session, url, host_limits, validators=(None, None), on_link=None):
+    # Conditional request if the directory was already crawled
+    request_headers = dict(headers)
+    etag, last_modified = validators
+    if etag:
+        request_headers['If-None-Match'] = etag
+    if last_modified:
+        request_headers['If-Modified-Since'] = last_modified
+
+    # Limit in-flight requests per host
+    with host_limits[urlsplit(url).netloc]:
+        try:
+            with session.get(url, headers=request_headers, proxies=proxies, verify=verify, stream=True) as r:
+                if r.status_code not in (200, 304):
+                    return url, None, f'HTTP response is not 200 ({r.status_code})'
+
+                # Parse links while the page is still downloading
+                links = []
+                if r.status_code == 200:
+                    for link in iter_links(r.iter_content(chunk_size=CHUNK_SIZE), r.encoding or 'utf-8'):
+                        links.append(link)
+                        if on_link:
+                            on_link(r.url, link)
+        except requests.RequestException as e:
+            return url, None, e
+
+    return url, {
+        'url': r.url,
+        'status': r.status_code,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'links': links
+    }, None
+
+
+def crawl(base_url, state, writer, workers=1, per_host=4, retries=3, checkpoint_every=100, reuse_subtrees=False):
+    # Size the connection pool to the number of workers
+    session = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    host_limits = {}
+    lock = threading.Lock()
+
+    # Directories found by the workers, waiting to be added to the state
+    discovered = queue.Queue()
+
+    def submit(url):
+        host = urlsplit(url).netloc
+        with lock:
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(per_host)
+
+            requested.add(canonicalize(url))
+
+        return executor.submit(fetch_index, session, url, host_limits, validators.get(url, (None, None)), on_link)
+
+    def on_link(url, link):
+        # Called by the workers, fetch new directories while the page is still being parsed
+        if link[-1:] != '/' or link == '/':
+            return
+
+        target = resolve(url, link)
+        with lock:
+            if canonicalize(target) in requested:
+                return
+            requested.add(canonicalize(target))
+
+        discovered.put((target, submit(target)))
+
+    def drain():
+        while not discovered.empty():
+            target, future = discovered.get()
+            state.add(target)
+            pending.add(future)
+
+    def reuse(url):
+        # Not modified, replay the stored listing without parsing it again
+        revalidate = []
+        targets = [url]
+        while len(targets) != 0:
+            current = targets.pop()
+            if not state.reuse(current):
+                revalidate.append(current)
+                continue
+
+            final_url, links = state.listing(current)
+            with lock:
+                requested.add(canonicalize(current))
+                requested.add(canonicalize(final_url))
+
+            for entry in extract_entries(final_url, links, writer.seen):
+                writer.write(entry)
+
+            for link in links:
+                target = resolve(final_url, link)
+                if link[-1:] == '/' and link != '/' and canonicalize(target) not in requested:
+                    if reuse_subtrees:
+                        targets.append(target)
+                    else:
+                        revalidate.append(target)
+
+        # Subdirectories still get a conditional request of their own
+        return revalidate
+
+    def checkpoint():
+        # Records must hit the disk before their pages are marked as done
+        writer.flush()
+        state.checkpoint()
+
+    # Failed urls get a fresh set of attempts on every run
+    state.add(base_url)
+    state.reset_attempts()
+
+    # Stale directories of an incremental crawl are yet to be confirmed
+    requested = set(canonicalize(url) for url in state.urls()) - set(canonicalize(url) for url in state.urls('stale'))
+    validators = state.validators()
+    writer.seen.add(canonicalize(base_url))
 
     total_scanned = 0
-    total = 1
+    since_checkpoint = 0
+    retry_round = 0
+    start_time = time.perf_counter()
+
+    state.retry(retries + 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            pending = set(submit(url) for url in state.urls('pending'))
+            while len(pending) != 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                # New directories must be in the state before their pages are done
+                drain()
+
+                for future in done:
+                    url, page, error = future.result()
+                    if error:
+                        print(f'ERROR: {url}: {error}')
+                        state.fail(url)
+                        continue
+
+                    if page['status'] == 304:
+                        for target in reuse(url):
+                            state.add(target)
+                            pending.add(submit(target))
+
+                        total_scanned += 1
+                        since_checkpoint += 1
+                        continue
+
+                    state.done(url, page['url'], page['links'], page['etag'], page['last_modified'])
+                    with lock:
+                        requested.add(canonicalize(page['url']))
+
+                    # Record new entries
+                    for entry in extract_entries(page['url'], page['links'], writer.seen):
+                        writer.write(entry)
+
+                    total_scanned += 1
+                    since_checkpoint += 1
+
+                # Checkpoint
+                if since_checkpoint >= checkpoint_every:
+                    checkpoint()
+                    since_checkpoint = 0
+
+                elapsed = time.perf_counter() - start_time
+                print(f'Scanned: {total_scanned}/{len(requested)} ({total_scanned / elapsed:.1f} pages/s)')
+
+            checkpoint()
+
+            if state.retry(retries + 1) == 0:
+                break
+
+            # Back off before retrying failed urls
+            retry_round += 1
+            delay = min(2 ** retry_round, 60)
+            print(f'Retrying failed directories in {delay}s...')
+            time.sleep(delay)
+
+    failed = state.urls('failed')
+    for url in failed:
+        print(f'WARNING: giving up on "{url}", run again with --resume to retry.')
+
+    return total_scanned
+
+
+def stored_entries(state, base_url):
+    # Rebuild the records of the listings stored in the state database
+    entries = {}
+    targets = [base_url]
+    seen = {canonicalize(base_url)}
 
     while len(targets) != 0:
-        current_target = targets.pop()
+        listing = state.listing(targets.pop())
+        if listing is None:
+            continue
+
+        url, links = listing
+        seen.add(canonicalize(url))
+
+        for entry in extract_entries(url, links, seen):
+            entries[canonicalize(entry['link'])] = entry
+
+            if entry['type'] == 'directory':
+                targets.append(entry['link'])
+
+    return entries
 
-        print(f'Scanning: "{current_target}"... {total_scanned}/{total}')
 
-        # Get index
-        r = requests.get(current_target, headers=headers, proxies=proxies, verify=verify)
-        if r.status_code != 200:
-            print('ERROR: HTTP response is not 200.')
-            exit(1)
+def iter_dump(path):
+    # Read a dump as legacy JSON array, NDJSON stream or plain list of urls
+    with open(path) as f:
+        head = f.read(1)
+        while head.isspace():
+            head = f.read(1)
+        f.seek(0)
 
-        # Increment
-        total_scanned += 1
+        if head == '[':
+            decoder = json.JSONDecoder()
+            buffer = f.read(65536)
+            pos = buffer.index('[') + 1
 
-        # Extract all links
-        for link in find_all_links(r.text):
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
 
-            # Skip already scanned
-            if link == '/' or ('http://unimia.unimi.it' + link) in already_scanned:
+                if buffer.startswith(']', pos):
+                    return
+
+                try:
+                    entry, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        raise
+                    buffer = buffer[pos:] + chunk
+                    pos = 0
+                    continue
+
+                yield entry
+
+        elif head == '{':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield {'type': 'directory' if line[-1] == '/' else 'file', 'link': line}
+
+
+def convert(input_file, output_file):
+    # Build the compact legacy JSON array one record at a time
+    with open(input_file) as src, open(output_file, 'w') as dst:
+        dst.write('[')
+
+        first = True
+        for line in src:
+            if not line.strip():
                 continue
 
-            # Extract filetype
-            link_type = 'file'
-            if link[-1] == '/':
-                link_type = 'directory'
-                total += 1
+            if not first:
+                dst.write(',')
+            dst.write(json.dumps(json.loads(line), separators=(',', ':')))
+            first = False
+
+        dst.write(']')
+
+
+def mirror_path(output_folder, url):
+    # Local tree matching the remote paths
+    path = os.path.normpath(unquote(urlsplit(url).path).lstrip('/'))
+    if path.startswith('..') or os.path.isabs(path):
+        raise ValueError(f'Refusing to write "{url}" outside of "{output_folder}".')
+
+    return os.path.join(output_folder, path)
+
+
+def mirror_file(session, url, output_file):
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    # Complete files only get their final name
+    with session.get(url, headers=headers, proxies=proxies, verify=verify, stream=True) as r:
+        r.raise_for_status()
+
+        size = 0
+        with open(output_file + '.part', 'wb') as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+
+    os.replace(output_file + '.part', output_file)
+
+    return size
+
+
+def mirror(dump_file, output_folder, workers=8, include=None, exclude=None):
+    session = requests.session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    summary = {'downloaded': 0, 'bytes': 0, 'skipped': 0, 'filtered': 0, 'failed': []}
+    start_time = time.perf_counter()
 
-            dump.append({'type': link_type, 'link': r.url + link})
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+
+        for entry in iter_dump(dump_file):
+            if entry['type'] != 'file':
+                continue
+
+            # Filter on the remote path
+            path = unquote(urlsplit(entry['link']).path)
+            if (include and not any(fnmatchcase(path, x) for x in include)) or (exclude and any(fnmatchcase(path, x) for x in exclude)):
+                summary['filtered'] += 1
+                continue
+
+            try:
+                output_file = mirror_path(output_folder, entry['link'])
+            except ValueError as e:
+                # A bad link fails on its own, like a failed download
+                print(f'ERROR: {entry["link"]}: {e}')
+                summary['failed'].append({'url': entry['link'], 'error': str(e)})
+                continue
+
+            if os.path.exists(output_file):
+                summary['skipped'] += 1
+                continue
+
+            futures[executor.submit(mirror_file, session, entry['link'], output_file)] = entry['link']
+
+            # Bound the number of queued downloads
+            if len(futures) >= workers * 4:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, futures.pop(future), summary, start_time)
+
+        done, _ = wait(futures)
+        for future in done:
+            collect(future, futures[future], summary, start_time)
+
+    summary['seconds'] = time.perf_counter() - start_time
+    summary['bytes_per_second'] = summary['bytes'] / summary['seconds'] if summary['seconds'] else 0
+
+    return summary
+
+
+def collect(future, url, summary, start_time):
+    try:
+        summary['bytes'] += future.result()
+        summary['downloaded'] += 1
+    except (requests.RequestException, OSError) as e:
+        print(f'ERROR: {url}: {e}')
+        summary['failed'].append({'url': url, 'error': str(e)})
+        return
+
+    elapsed = time.perf_counter() - start_time
+    print(f'Downloaded: {url} ({sizeof_fmt(summary["bytes"] / elapsed)}/s)')
+
+
+def main_crawl(args):
+    global proxies
+    if args.no_proxy:
+        proxies = None
+
+    start_time = time.perf_counter()
+
+    if (args.resume or args.incremental) and not os.path.exists(args.state):
+        print(f'ERROR: cannot {"resume" if args.resume else "re-crawl"}, "{args.state}" does not exist.')
+        exit(1)
+
+    state = CrawlState(args.state, args.resume or args.incremental)
+    writer = DumpWriter(args.output, args.resume)
+    try:
+        if args.incremental:
+            previous = stored_entries(state, args.base_url)
+            state.begin_incremental(args.base_url)
+
+        total_scanned = crawl(args.base_url, state, writer, args.workers, args.per_host, args.retries, args.checkpoint_every, args.reuse_subtrees)
+
+        if args.incremental:
+            # Keep the stored subtrees of directories that could not be fetched
+            if len(state.urls('failed')) == 0:
+                state.prune()
+
+            current = stored_entries(state, args.base_url)
+
+            # Write what changed since the previous crawl
+            added = [x for key, x in current.items() if key not in previous]
+            removed = [x for key, x in previous.items() if key not in current]
+            with open(args.delta, 'w') as f:
+                for change, entries in (('added', added), ('removed', removed)):
+                    for entry in entries:
+                        f.write(json.dumps({'change': change, **entry}, separators=(',', ':')) + '\n')
+
+            print(f'Added {len(added)} entries, removed {len(removed)} entries.')
+    finally:
+        writer.close()
+        state.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f'Scanned {total_scanned} pages in {elapsed:.1f}s ({total_scanned / elapsed:.1f} pages/s)')
+
+    if args.json:
+        convert(args.output, args.json)
+
+
+def main_convert(args):
+    convert(args.input, args.output)
+
+
+def main_mirror(args):
+    global proxies
+    if args.no_proxy:
+        proxies = None
+
+    summary = mirror(args.dump, args.output, args.workers, args.include, args.exclude)
+
+    print(f'Downloaded {summary["downloaded"]} files ({sizeof_fmt(summary["bytes"])}) in {summary["seconds"]:.1f}s ({sizeof_fmt(summary["bytes_per_second"])}/s)')
+    print(f'Skipped {summary["skipped"]} existing files, {summary["filtered"]} filtered out, {len(summary["failed"])} failed.')
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if len(summary['failed']) != 0:
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
 
-            if link_type != 'file':
-                targets.append(r.url + link)
-            else:
-                #print(f' -> Found {link}')
-                pass
+    crawl_parser = subparsers.add_parser('crawl', help='crawl the autoindex')
+    crawl_parser.add_argument('-u', '--base-url', help='autoindex to crawl', default=BASE_URL)
+    crawl_parser.add_argument('-o', '--output', help='NDJSON dump file', default='server_dump.ndjson')
+    crawl_parser.add_argument('-j', '--json', help='also write the dump as a legacy JSON array')
+    crawl_parser.add_argument('-w', '--workers', help='directory fetches in flight (1 = serial crawl)', type=int, default=1)
+    crawl_parser.add_argument('--per-host', help='max requests in flight to the same host', type=int, default=4)
+    crawl_parser.add_argument('-s', '--state', help='crawl state database', default='crawl_state.db')
+    crawl_parser.add_argument('-r', '--resume', help='resume an interrupted crawl from the state database', action='store_true')
+    crawl_parser.add_argument('-i', '--incremental', help='re-crawl with conditional requests, reusing unchanged directories', action='store_true')
+    crawl_parser.add_argument('--reuse-subtrees', help='trust a 304 for the whole subtree of a directory (incremental crawl)', action='store_true')
+    crawl_parser.add_argument('-d', '--delta', help='changes found by an incremental crawl', default='server_dump.delta.ndjson')
+    crawl_parser.add_argument('--retries', help='retries for a failed directory before giving up', type=int, default=3)
+    crawl_parser.add_argument('--no-proxy', help='connect directly instead of through the local proxy', action='store_true')
+    crawl_parser.add_argument('--checkpoint-every', help='pages between two checkpoints', type=int, default=100)
+    crawl_parser.set_defaults(func=main_crawl)
 
+    convert_parser = subparsers.add_parser('convert', help='convert an NDJSON dump to a legacy JSON array')
+    convert_parser.add_argument('input', help='NDJSON dump file')
+    convert_parser.add_argument('output', help='JSON dump file', nargs='?', default='server_dump.json')
+    convert_parser.set_defaults(func=main_convert)
 
-        already_scanned.append(r.url)
+    mirror_parser = subparsers.add_parser('mirror', help='download the files of a dump (JSON, NDJSON or list of urls)')
+    mirror_parser.add_argument('dump', help='dump file')
+    mirror_parser.add_argument('-o', '--output', help='folder for the local tree', default='mirror')
+    mirror_parser.add_argument('-w', '--workers', help='downloads in flight', type=int, default=8)
+    mirror_parser.add_argument('--include', help='only paths matching this pattern, e.g. "/imageserver/legacy/*"', action='append')
+    mirror_parser.add_argument('--exclude', help='skip paths matching this pattern', action='append')
+    mirror_parser.add_argument('--summary', help='write the summary as JSON')
+    mirror_parser.add_argument('--no-proxy', help='connect directly instead of through the local proxy', action='store_true')
+    mirror_parser.set_defaults(func=main_mirror)
 
-    with open('server_dump.json', 'w') as f:
-        f.write(json.dumps(dump, separators=(',', ':')))
\ No newline at end of file
+    args = parser.parse_args()
+    args.func(args)